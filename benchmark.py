@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+# standard libraries
+import argparse
+import http.server
+import json
+import os
+import random
+import shutil
+import signal
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROGRAM_DESCRIPTION="""
+
+    README:
+
+    This program measures how fast 'vaccineChecker.py' can query sites, without
+    touching any real provider website.
+
+    It starts a local HTTP server that stands in for the providers:
+
+    * `phrase` pages: small pages, multi-MB pages, and pages with large comment blocks
+    * with --trickle, `phrase` pages that never finish, sending a byte every half second
+    * the CVS `vaccine-status.{state}.json` feed
+    * the HEB `vaccine_locations.json` feed
+
+    with a configurable latency and error rate.  It then writes a 'websites.json' with
+    the requested number of sites pointed at that server, runs 'vaccineChecker.py' for
+    one sweep over all of them (--repeat times), and reports the sweep time,
+    requests/sec, peak RSS and CPU time per site of the 'vaccineChecker.py' process.
+
+    EXAMPLE USE (Command Line):
+
+    # 1000 sites, 50 at a time, with 100 ms of latency on every response
+    ./benchmark.py --sites 1000 --max-concurrency 50 --latency 100
+
+    # 10000 sites, only CVS and HEB, 5% of responses failing
+    ./benchmark.py --sites 10000 --mix 0:1:1 --error-rate 0.05
+
+    # 10 sites plus 2 that trickle in; each sweep should end soon after their 'max_time'
+    ./benchmark.py --sites 10 --trickle 2
+
+    """
+
+NEG_PHRASE = "are full"
+POS_PHRASE = "Available Now"
+STATES = ["TX", "CA", "FL", "NY"]
+CITIES = 200 # cities per state in the stand-in feeds
+TRICKLE_INTERVAL = 0.5 # seconds between the bytes of a trickling page
+TRICKLE_MAX_TIME = 2 # 'max_time' of the sites with a trickling page
+
+'''
+Handle Ctrl+C
+'''
+def SignalHandler(sig, frame):
+    print("INFO: Program interrupted via Ctrl-C.  Exiting")
+    sys.exit(0)
+
+'''
+Stand-in for the provider websites.  Response bodies are built once up front so
+the server itself costs as little as possible during a run.
+'''
+class ProviderServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency, errorRate, largePageBytes):
+        self.m_latency = latency # seconds added to every response
+        self.m_errorRate = errorRate # fraction of responses that are a 500
+        self.m_pages = self.build_pages(largePageBytes)
+        http.server.HTTPServer.__init__(self, ("127.0.0.1", 0), ProviderRequestHandler)
+
+    '''
+    Returns a dict of path -> body.
+    '''
+    def build_pages(self, largePageBytes):
+        pages = {}
+
+        filler = "<p>Thank you for your interest in the COVID-19 vaccine. Please read the information below.</p>\n"
+        pages["/phrase/small"] = ("<html><body>" + filler * 20 + "Appointments " + NEG_PHRASE + ".</body></html>").encode("utf-8")
+        pages["/phrase/large"] = ("<html><body>" + filler * (largePageBytes // len(filler)) + "Appointments " + NEG_PHRASE + ".</body></html>").encode("utf-8")
+
+        # the positive phrase only shows up inside comments, so it must not be found
+        comment = "<!-- old banner: " + POS_PHRASE + " " + ("x" * 4000) + " -->\n"
+        pages["/phrase/comments"] = ("<html><body>" + (comment + filler) * (largePageBytes // (len(comment) + len(filler))) + "</body></html>").encode("utf-8")
+
+        for state in STATES:
+            data = [{ "city" : "CITY %d" % (i), "status" : "Available" if i % 10 == 0 else "Fully Booked" } for i in range(CITIES)]
+            pages["/cvs/vaccine-status.%s.json" % (state.lower())] = json.dumps({ "responsePayloadData" : { "data" : { state : data } } }).encode("utf-8")
+
+        locations = []
+        for i in range(CITIES):
+            for store in range(3):
+                locations.append({ "city" : "City %d" % (i), "zip" : "7%04d" % (i), "openTimeslots" : 1 if (i + store) % 7 == 0 else 0 })
+        pages["/heb/vaccine_locations.json"] = json.dumps({ "locations" : locations }).encode("utf-8")
+
+        return pages
+
+class ProviderRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # keep-alive, like the real providers
+
+    def do_GET(self):
+        if self.server.m_latency:
+            time.sleep(self.server.m_latency)
+
+        path = self.path.split("?")[0]
+        if path.startswith("/trickle/"):
+            self.trickle()
+            return
+        if path.startswith("/phrase/"):
+            path = path[:path.rfind("/")] # strip the per-site suffix
+        body = self.server.m_pages.get(path)
+
+        if body is None:
+            self.send_error(404)
+            return
+        if random.random() < self.server.m_errorRate:
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if path.endswith(".json") else "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    '''
+    A page that never finishes: one byte every TRICKLE_INTERVAL seconds until the client
+    hangs up.
+    '''
+    def trickle(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(1024 * 1024))
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(b" ")
+                self.wfile.flush()
+                time.sleep(TRICKLE_INTERVAL)
+        except OSError:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+Write a 'websites.json' with 'count' sites split between types by 'mix', which is a
+"phrase:cvs:heb" ratio.  'phrase' sites are split between small, large and comment
+heavy pages by 'pageMix', a "small:large:comments" ratio.  'trickle' more 'phrase'
+sites get a page that never finishes.  Returns the number of sites of each type.
+'''
+def write_websites(filename, count, mix, pageMix, baseUrl, trickle):
+    types = weighted(["phrase", "cvs", "heb"], mix)
+    pages = weighted(["small", "large", "comments"], pageMix)
+
+    websites = {}
+    counts = { "phrase" : 0, "cvs" : 0, "heb" : 0 }
+    for i in range(count):
+        t = types[i % len(types)]
+        counts[t] += 1
+        name = "Site %d" % (i)
+        if "phrase" == t:
+            page = pages[counts[t] % len(pages)]
+            websites[name] = { "type" : "phrase", "website" : "%s/phrase/%s/%d" % (baseUrl, page, i), "neg_phrase" : NEG_PHRASE, "pos_phrase" : POS_PHRASE }
+        elif "cvs" == t:
+            websites[name] = { "type" : "cvs", "website" : baseUrl, "state" : STATES[i % len(STATES)], "city" : "City %d" % (i % CITIES) }
+        else:
+            websites[name] = { "type" : "heb", "website" : baseUrl, "city" : "City %d" % (i % CITIES) }
+    for i in range(trickle):
+        websites["Trickle %d" % (i)] = { "type" : "phrase", "website" : "%s/trickle/%d" % (baseUrl, i), "neg_phrase" : NEG_PHRASE, "pos_phrase" : POS_PHRASE, "max_time" : TRICKLE_MAX_TIME }
+
+    f = open(filename, "w")
+    f.write(json.dumps(websites, indent=4))
+    f.close()
+    return counts
+
+'''
+Expand a ratio like "6:2:2" into a list with each item repeated by its weight.
+'''
+def weighted(items, ratio):
+    weights = [int(w) for w in ratio.split(":")]
+    if len(weights) != len(items) or sum(weights) <= 0 or min(weights) < 0:
+        raise ValueError("ratio '%s' must be %d non-negative numbers separated by ':'" % (ratio, len(items)))
+    out = []
+    for item, weight in zip(items, weights):
+        out += [item] * weight
+    return out
+
+'''
+Sum the samples of each metric in a Prometheus text file written by --metrics-file.
+'''
+def read_metrics(filename):
+    totals = {}
+    f = open(filename)
+    for line in f:
+        if line.startswith("#") or not line.strip():
+            continue
+        name, value = line.rsplit(" ", 1)
+        name = name.split("{")[0]
+        totals[name] = totals.get(name, 0) + float(value)
+    f.close()
+    return totals
+
+'''
+Run 'vaccineChecker.py' for one sweep.  Returns a dict of measurements.
+'''
+def run_once(args, websitesFile, workDir, baseUrl):
+    outputDir = workDir + "/status"
+    metricsFile = workDir + "/metrics.prom"
+    shutil.rmtree(outputDir, ignore_errors=True)
+
+    command = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + "/vaccineChecker.py",
+        "--websites", websitesFile,
+        "--output-dir", outputDir,
+        "--max-attempts", "1",
+        "--max-concurrency", str(args.maxConcurrency),
+        "--host-rate", "0", # every stand-in site is on 127.0.0.1, which would be rate limited as one host
+        "--metrics-file", metricsFile,
+        "--log-level", args.logLevel,
+        "--cvs-url", baseUrl + "/cvs/vaccine-status.{}.json?vaccineinfo",
+        "--heb-url", baseUrl + "/heb/vaccine_locations.json"]
+    if not args.circuitBreaker:
+        command.append("--no-circuit-breaker")
+
+    start = time.time()
+    p = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    if not os.WIFEXITED(status) or 0 != os.WEXITSTATUS(status):
+        raise RuntimeError("vaccineChecker.py did not exit cleanly (wait status %d)" % (status))
+
+    metrics = read_metrics(metricsFile)
+    sweep = metrics["vaccinechecker_sweep_duration_seconds_sum"]
+    responses = metrics.get("vaccinechecker_http_responses_total", 0)
+    return {
+        "wall" : elapsed,
+        "sweep" : sweep,
+        "requests" : responses,
+        "rps" : responses / sweep if sweep else 0,
+        "rss" : usage.ru_maxrss / 1024.0, # MB, ru_maxrss is in KB on Linux
+        "cpu" : usage.ru_utime + usage.ru_stime,
+        "timeouts" : metrics.get("vaccinechecker_timeouts_total", 0),
+        "errors" : metrics.get("vaccinechecker_errors_total", 0),
+        "skipped" : metrics.get("vaccinechecker_circuit_skips_total", 0),
+        "bytes" : metrics.get("vaccinechecker_response_bytes_total", 0),
+    }
+
+def report(label, r, sites):
+    print("%-8s sweep %7.2f s | %8.1f requests/sec | peak RSS %7.1f MB | CPU %6.2f s (%.3f ms/site) | %.1f MB downloaded | %d timeouts, %d errors, %d skipped by the circuit breaker" % (
+        label, r["sweep"], r["rps"], r["rss"], r["cpu"], 1000.0 * r["cpu"] / sites, r["bytes"] / (1024 * 1024), r["timeouts"], r["errors"], r["skipped"]))
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGINT, SignalHandler)
+
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+            '--sites',
+            action="store",
+            dest="sites",
+            type=int,
+            help="How many sites to put in the generated 'websites.json'.  Default is 100.",
+            required=False,
+            metavar="[x]",
+            default=100)
+
+    parser.add_argument(
+            '--mix',
+            action="store",
+            dest="mix",
+            help="Ratio of 'phrase':'cvs':'heb' sites.  Default is 6:2:2.",
+            required=False,
+            metavar="[x]",
+            default="6:2:2")
+
+    parser.add_argument(
+            '--page-mix',
+            action="store",
+            dest="pageMix",
+            help="Ratio of small:multi-MB:comment heavy pages among 'phrase' sites.  Default is 8:1:1.",
+            required=False,
+            metavar="[x]",
+            default="8:1:1")
+
+    parser.add_argument(
+            '--trickle',
+            action="store",
+            dest="trickle",
+            type=int,
+            help="How many 'phrase' sites, on top of --sites, get a page that sends a byte every %.1f seconds and never finishes.  Their 'max_time' is %d seconds, so each should count as an error and no sweep should take much longer than that.  Default is 0." % (TRICKLE_INTERVAL, TRICKLE_MAX_TIME),
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--large-page-mb',
+            action="store",
+            dest="largePageMB",
+            type=float,
+            help="Size of the multi-MB and comment heavy pages, in MB.  Default is 4.",
+            required=False,
+            metavar="[x]",
+            default=4)
+
+    parser.add_argument(
+            '--latency',
+            action="store",
+            dest="latency",
+            type=float,
+            help="Milliseconds the stand-in server waits before every response.  Default is 0.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--error-rate',
+            action="store",
+            dest="errorRate",
+            type=float,
+            help="Fraction (0 to 1) of responses that are a '500 Internal Server Error'.  Default is 0.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--circuit-breaker',
+            action="store_true",
+            dest="circuitBreaker",
+            help="Leave the circuit breaker of 'vaccineChecker.py' on, so that with --error-rate the stand-in host stops being asked after a few failures in a row.  Off by default, so every site is queried.",
+            required=False,
+            default=False)
+
+    parser.add_argument(
+            '--max-concurrency',
+            action="store",
+            dest="maxConcurrency",
+            type=int,
+            help="Passed on to 'vaccineChecker.py'.  Default is 10.",
+            required=False,
+            metavar="[x]",
+            default=10)
+
+    parser.add_argument(
+            '--log-level',
+            action="store",
+            dest="logLevel",
+            help="Passed on to 'vaccineChecker.py'.  Default is WARNING, so the benchmark doesn't flood syslog.",
+            required=False,
+            metavar="[x]",
+            default="WARNING")
+
+    parser.add_argument(
+            '--repeat',
+            action="store",
+            dest="repeat",
+            type=int,
+            help="How many times to run the sweep.  The median of the runs is reported too.  Default is 3.",
+            required=False,
+            metavar="[x]",
+            default=3)
+
+    args = parser.parse_args()
+
+    if (args.sites < 1 or args.repeat < 1):
+        print("ERROR: --sites and --repeat must be positive numbers")
+        sys.exit(-1)
+
+    if (args.trickle < 0):
+        print("ERROR: --trickle can't be negative")
+        sys.exit(-1)
+
+    server = ProviderServer(args.latency / 1000.0, args.errorRate, int(args.largePageMB * 1024 * 1024))
+    thread = threading.Thread(target=server.serve_forever, name="providers")
+    thread.daemon = True
+    thread.start()
+    baseUrl = "http://127.0.0.1:%d" % (server.server_address[1])
+
+    workDir = tempfile.mkdtemp(prefix="vaccineChecker-benchmark-")
+    try:
+        websitesFile = workDir + "/websites.json"
+        try:
+            counts = write_websites(websitesFile, args.sites, args.mix, args.pageMix, baseUrl, args.trickle)
+        except ValueError as e:
+            print("ERROR: " + str(e))
+            sys.exit(-1)
+
+        print("INFO: %d sites (%d phrase, %d cvs, %d heb), stand-in server at %s, %.0f ms latency, %.1f%% errors" % (
+            args.sites, counts["phrase"], counts["cvs"], counts["heb"], baseUrl, args.latency, 100 * args.errorRate))
+        if args.trickle:
+            print("INFO: plus %d sites whose page trickles in, with a 'max_time' of %d seconds" % (args.trickle, TRICKLE_MAX_TIME))
+
+        results = []
+        for i in range(args.repeat):
+            r = run_once(args, websitesFile, workDir, baseUrl)
+            report("run %d" % (i + 1), r, args.sites + args.trickle)
+            if args.trickle and r["errors"] < args.trickle:
+                print("WARNING: only %d errors, but %d pages never finish" % (r["errors"], args.trickle))
+            results.append(r)
+
+        if 1 < len(results):
+            median = dict((k, statistics.median(r[k] for r in results)) for k in results[0])
+            report("median", median, args.sites + args.trickle)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workDir, ignore_errors=True)
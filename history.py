@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# standard libraries
+import argparse
+import os
+import signal
+import sys
+import time
+
+from vaccineChecker import Availability, HistoryStore, vaccineChecker
+
+PROGRAM_DESCRIPTION="""
+
+    README:
+
+    This program answers questions about the poll history recorded by
+    'vaccineChecker.py --history', without replaying any archive files.
+
+    EXAMPLE USE (Command Line):
+
+    # the sites with history, how often they were polled and when last
+    ./history.py sites
+
+    # when did 'HEB San Antonio' last go MAYBE (and when was it last seen MAYBE)
+    ./history.py last "HEB San Antonio" maybe
+
+    # percentage of polls per hour 'HEB San Antonio' was MAYBE or PROBABLY, last 2 days
+    ./history.py hourly "HEB San Antonio" --days 2
+
+    """
+
+'''
+Handle Ctrl+C
+'''
+def SignalHandler(sig, frame):
+    print("INFO: Program interrupted via Ctrl-C.  Exiting")
+    sys.exit(0)
+
+def format_time(t):
+    if t is None:
+        return "never"
+    return time.strftime("%d-%b-%Y %I:%M:%S %p", time.localtime(t))
+
+'''
+'maybe', 'MAYBE', 'probably_not', 'probably not' ... -> the status as it is recorded.
+'''
+def parse_status(value):
+    try:
+        return Availability[value.upper().replace(" ", "_")].value
+    except KeyError:
+        print("ERROR: status must be one of %s" % (", ".join(a.name for a in Availability)))
+        sys.exit(-1)
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGINT, SignalHandler)
+
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+            '--output-dir',
+            action="store",
+            dest="outputDir",
+            help="The --output-dir 'vaccineChecker.py' was run with.  Default is 'status'.",
+            required=False,
+            metavar="[dir]",
+            default="status")
+
+    commands = parser.add_subparsers(dest="command", metavar="[command]")
+    commands.required = True
+
+    commands.add_parser("sites", help="List the sites with history.")
+
+    last = commands.add_parser("last", help="When a site last changed to a status, and was last seen with it.")
+    last.add_argument("site")
+    last.add_argument("status")
+
+    hourly = commands.add_parser("hourly", help="Percentage of polls per hour a site was MAYBE or PROBABLY.")
+    hourly.add_argument("site")
+    hourly.add_argument(
+            '--days',
+            action="store",
+            dest="days",
+            type=float,
+            help="How many days back to go.  Default is 1.",
+            required=False,
+            metavar="[x]",
+            default=1)
+
+    args = parser.parse_args()
+
+    filename = os.path.join(args.outputDir, vaccineChecker.HISTORY_FILENAME)
+    if (not os.path.exists(filename)):
+        print("ERROR: " + filename + " not found.  Was 'vaccineChecker.py' run with --history?")
+        sys.exit(-1)
+    history = HistoryStore(filename)
+
+    if "sites" == args.command:
+        for site, polls, lastPoll in history.sites():
+            print("%s: %d polls, last %s" % (site, polls, format_time(lastPoll)))
+
+    elif "last" == args.command:
+        status = parse_status(args.status)
+        print("%s last changed to %s: %s" % (args.site, status, format_time(history.last_transition(args.site, status))))
+        print("%s last seen %s: %s" % (args.site, status, format_time(history.last_seen(args.site, status))))
+
+    elif "hourly" == args.command:
+        for hour, polls, available in history.hourly_availability(args.site, time.time() - args.days * 24 * 60 * 60):
+            print("%s  %5.1f%%  (%d polls)" % (time.strftime("%d-%b-%Y %I:00 %p", time.localtime(hour)), available, polls))
@@ -8,8 +8,8 @@ OVERVIEW:
     'status.json' (or a symlink to it).
 
     The webpage displays a list of boxes with fields populated by 'vaccineChecker.py'
-    into a 'status.json' file.  This webpage cares about the 'status', 'website', and 'update_time'
-    fields.
+    into a 'status.json' file.  This webpage cares about the 'status', 'website', 'update_time'
+    and 'stale' fields.  'stale' is true when the last attempt to update the site failed.
 
     Example 'status.json':
 
@@ -28,6 +28,18 @@ OVERVIEW:
         }
 }
 
+    'vaccineChecker.py' also writes 'status.fragment.html' (the site buttons, already
+    filled in) and 'status.min.json' (only the fields this page refreshes from), each
+    with '.gz' / '.br' pre-compressed copies, whenever 'status.json' changes.  If they
+    are next to this page (or symlinked like 'status.json'), this page uses them and
+    never parses 'status.json', and the web server can answer the page's refreshes
+    from static files with conditional GETs (i.e. nginx 'gzip_static on;').
+
+    If 'vaccineChecker.py' is run with --push-port, set PUSH_URL to where the web
+    server proxies its '/events' (i.e. '/savaccine/events').  Status changes then
+    show up as soon as they happen, and 'status.json' is only re-read once a minute
+    (for the update times).
+
     The "sound alert" button on the webpage is enabled by defining the 
     SOUND_ALERT_FILE variable with the URL of an .mp3 to play upon a site
     showing possible vaccination slots.  If the SOUND_ALERT_FILE
@@ -56,6 +68,9 @@ else { $DEBUG_TEST = False; }
 // set to empty string to disable 'sound alert' button
 $SOUND_ALERT_FILE = 'https://amasmiller.com/sheep.mp3';
 
+// URL of the 'vaccineChecker.py --push-port' events, empty string to poll 'status.json' instead
+$PUSH_URL = '';
+
 ?>
 
 <html>
@@ -245,6 +260,10 @@ body
             site = data[name];
             text = "<b>" + name + "</b><br>slots " + site.status + " available<br>" +
                 ((("update_time" in site) && ("" != site.update_time)) ? ("as of " + site.update_time) : "<br>");
+            if (site.stale)
+            {
+                text += "<br><i>(site not responding, may be out of date)</i>";
+            }
             id = name.replace(new RegExp(" ", "g"), "-");
             $("#".concat(id)).html(text);
             switch (site.status) 
@@ -282,12 +301,34 @@ body
         $("#last-refresh").text(t);
     }
 
-    // setup the polling
-    var status_file = "status.json";
-    setInterval(function() { $.getJSON(status_file, function(data) { update(data); }).fail(function(jqXHR) { console.log(jqXHR.status); })}, 1000);
+    // setup the polling.  'ifModified' sends the ETag of the last response, so when
+    // nothing changed the server answers '304 Not Modified' without a body.
+    var status_file = <?php echo json_encode(file_exists("status.min.json") ? "status.min.json" : "status.json"); ?>;
+    var lastData = null;
+    function poll() {
+        $.ajax({ url: status_file, dataType: "json", ifModified: true, success: function(data, textStatus) {
+            if ("notmodified" != textStatus) { lastData = data; }
+            if (null != lastData) { update(lastData); }
+        }}).fail(function(jqXHR) { console.log(jqXHR.status); });
+    }
+    var push_url = <?php echo json_encode($PUSH_URL); ?>;
+    if ("" != push_url && window.EventSource)
+    {
+        var events = new EventSource(push_url);
+        events.addEventListener("snapshot", function(e) { lastData = JSON.parse(e.data); update(lastData); });
+        events.addEventListener("transition", function(e) {
+            var t = JSON.parse(e.data);
+            if (null != lastData && t.name in lastData) { lastData[t.name].status = t.to; lastData[t.name].stale = false; update(lastData); }
+        });
+        setInterval(poll, 60000);
+    }
+    else
+    {
+        setInterval(poll, 1000);
+    }
     $(document).ready(function() { 
         $.ajaxSetup({ cache: false }); 
-        $.getJSON(status_file, function(data) { update(data); });
+        poll();
     });
 </script>
 <?php
@@ -300,9 +341,14 @@ $REFRESH_RATE = 5; // minutes
 
 // read the output of vaccine-checker.py
 $STATUS_JSON = "status.json";
+$STATUS_HTML = "status.fragment.html"; // the buttons below, pre-rendered
 if (!file_exists($STATUS_JSON)) { print_n("Sorry, the site's not working."); return; }; 
-$items = json_decode(file_get_contents($STATUS_JSON), true);
-ksort($items);
+$PRERENDERED = file_exists($STATUS_HTML) && !$DEBUG_TEST;
+if (!$PRERENDERED)
+{
+    $items = json_decode(file_get_contents($STATUS_JSON), true);
+    ksort($items);
+}
 
 // get the HTML party started
 print_n("<body>");
@@ -314,6 +360,7 @@ print_n("<a href=http://sanantoniovaccine.com>sanantoniovaccine.com</a>");
 print_n("<br><br>");
 
 // print out each button
+if ($PRERENDERED) { readfile($STATUS_HTML); $items = array(); }
 $allurls = "";
 foreach ($items as $name => $info)
 {
@@ -322,20 +369,24 @@ foreach ($items as $name => $info)
     // special case
     $website = "";
     if (array_key_exists('display_website', $info)) { $website = $info['display_website']; } 
-    else { $website = $info['website']; }
+    else if (array_key_exists('website', $info)) { $website = $info['website']; }
+    $onclick = ($website == "") ? "" : "window.open('".$website."', '_blank');";
 
     // text is filled in by javascript
     $id = str_replace(" ", "-", $name); // ids cannot have spaces
-    print_n("<button id=\"$id\" style=\"$style\" class=\"button\" onclick=\"window.open('".$website."', '_blank');\"/></button>");
+    print_n("<button id=\"$id\" style=\"$style\" class=\"button\" onclick=\"".$onclick."\"/></button>");
 
     // for bottom button
-    $allurls .= "window.open('".$website."', '_blank');";
+    $allurls .= $onclick;
 }
 
-$text = "Open all of them.";
-print_n("<button style=\"background-color: #F9F1F0\" class=\"button\" onclick=\"$allurls\">");
-print_n("$text");
-print_n("</button>");
+if (!$PRERENDERED)
+{
+    $text = "Open all of them.";
+    print_n("<button style=\"background-color: #F9F1F0\" class=\"button\" onclick=\"$allurls\">");
+    print_n("$text");
+    print_n("</button>");
+}
 
 print_n("<br><br>");
 ?>
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+# standard libraries
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from vaccineChecker import ArchiveStore, Availability, PROVIDERS, PhraseProvider, vaccineChecker
+
+PROGRAM_DESCRIPTION="""
+
+    README:
+
+    This program replays what 'vaccineChecker.py --archive' saved through the current
+    rules in 'websites.json', as fast as the machine allows, and reports the status
+    transitions that would result.  Use it to backtest a change to 'pos_phrase' /
+    'neg_phrase' against months of pages before putting it live.  No website is
+    contacted.
+
+    Both archive layouts under '[output dir]/archive' are read:
+
+    * the one from older versions: '[name].html.[time]' and 'status.json.[time]' files
+    * the current one: 'archive/index/*.jsonl' and the blobs they list
+
+    Archived pages of 'phrase' sites are classified again with the site's phrases from
+    'websites.json', by the same PhraseMatcher the daemon uses.  For every other site
+    (i.e. 'cvs', 'heb', whose feeds aren't archived), the statuses recorded in the
+    archived 'status.json' snapshots are replayed as they are.
+
+    EXAMPLE USE (Command Line):
+
+    # what would the archive in 'status/archive' look like with the rules in 'new.json'
+    ./replay.py --websites new.json --output-dir status
+
+    # the same, only for one site, and only the summary
+    ./replay.py --websites new.json --site "San Antonio Metro Health" --quiet
+
+    """
+
+'''
+Handle Ctrl+C
+'''
+def SignalHandler(sig, frame):
+    print("INFO: Program interrupted via Ctrl-C.  Exiting")
+    sys.exit(0)
+
+'''
+Everything in 'archiveDir', as (time, kind, site, path, compressed), oldest first.
+'kind' is "html" (one site's page) or "status" (a 'status.json' snapshot; 'site'
+is then None).
+'''
+def list_documents(archiveDir):
+    documents = []
+
+    # older versions: one file per document, the time at the end of its name
+    for filename in os.listdir(archiveDir):
+        path = os.path.join(archiveDir, filename)
+        if not os.path.isfile(path) or filename.endswith(".tmp"):
+            continue
+        if filename.startswith(vaccineChecker.STATUS_JSON_FILENAME + "."):
+            documents.append((filename[len(vaccineChecker.STATUS_JSON_FILENAME) + 1:], "status", None, path, False))
+        elif ".html." in filename:
+            site, sep, when = filename.rpartition(".html.")
+            documents.append((when, "html", site, path, False))
+
+    # current versions: the index of the blob store
+    if os.path.isdir(os.path.join(archiveDir, "index")):
+        store = ArchiveStore(archiveDir, 0, print)
+        for record in store.entries():
+            site = None if "status" == record["kind"] else record["site"]
+            documents.append((record["time"], record["kind"], site, store.blob_path(record["blob"]), True))
+
+    documents.sort(key=lambda d: d[0])
+    return documents
+
+# classification state of each worker process, set up by init_worker()
+WORKER_PROVIDER = None
+
+def init_worker(websites):
+    global WORKER_PROVIDER
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    WORKER_PROVIDER = PhraseProvider(None)
+    for name, site in websites.items():
+        WORKER_PROVIDER.prepare(name, site)
+
+'''
+Runs in the worker processes.  Returns the status of an "html" document, or the
+statuses of all the sites in a "status" snapshot as a dict.
+'''
+def classify(document):
+    when, kind, site, path, compressed = document
+    f = gzip.open(path, "rb") if compressed else open(path, "rb")
+    data = f.read()
+    f.close()
+    if "status" == kind:
+        return dict((name, s.get("status")) for name, s in json.loads(data.decode("utf-8")).items() if isinstance(s, dict))
+    status, html = WORKER_PROVIDER.m_matchers[site].scan([data], False)
+    return status.value
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGINT, SignalHandler)
+
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+            '--websites',
+            action="store",
+            dest="websitesFile",
+            help="The 'websites.json' with the rules to replay the archive through.",
+            required=True,
+            metavar="[file]")
+
+    parser.add_argument(
+            '--output-dir',
+            action="store",
+            dest="outputDir",
+            help="The --output-dir 'vaccineChecker.py' was run with.  Its 'archive' subdirectory is replayed.  Default is 'status'.",
+            required=False,
+            metavar="[dir]",
+            default="status")
+
+    parser.add_argument(
+            '--site',
+            action="store",
+            dest="site",
+            help="Only replay this site.",
+            required=False,
+            metavar="[name]",
+            default="")
+
+    parser.add_argument(
+            '--processes',
+            action="store",
+            dest="processes",
+            type=int,
+            help="How many processes classify documents.  Default is the number of CPUs.",
+            required=False,
+            metavar="[x]",
+            default=multiprocessing.cpu_count())
+
+    parser.add_argument(
+            '--quiet',
+            action="store_true",
+            dest="quiet",
+            help="Only print the summary, not every transition.",
+            required=False,
+            default=False)
+
+    args = parser.parse_args()
+
+    if (args.processes < 1):
+        print("ERROR: --processes must be a positive number")
+        sys.exit(-1)
+
+    archiveDir = os.path.join(args.outputDir, "archive")
+    if (not os.path.isdir(archiveDir)):
+        print("ERROR: " + archiveDir + " not found.  Was 'vaccineChecker.py' run with --archive?")
+        sys.exit(-1)
+
+    f = open(args.websitesFile)
+    websites = json.loads(f.read())
+    f.close()
+    phraseSites = dict((name, site) for name, site in websites.items() if PROVIDERS.get(site.get("type", "").lower()) == "PhraseProvider")
+
+    # pages of sites without rules can't be classified; the other sites come from the snapshots
+    documents = []
+    skipped = 0
+    for document in list_documents(archiveDir):
+        when, kind, site, path, compressed = document
+        if "html" == kind and site not in phraseSites:
+            skipped += 1
+        elif "html" == kind and "" != args.site and site != args.site:
+            continue
+        else:
+            documents.append(document)
+    replayedPages = set(d[2] for d in documents if "html" == d[1])
+
+    statuses = {}
+    transitions = 0
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, init_worker, (phraseSites,))
+    try:
+        for document, result in zip(documents, pool.imap(classify, documents, chunksize=32)):
+            when, kind, site, path, compressed = document
+            if "status" == kind:
+                results = [(name, status, "recorded") for name, status in result.items() if name not in replayedPages]
+            else:
+                results = [(site, result, "classified")]
+            for name, status, source in results:
+                if ("" != args.site and name != args.site) or status is None:
+                    continue
+                last = statuses.get(name, Availability.PROBABLY_NOT.value)
+                if status != last:
+                    transitions += 1
+                    if not args.quiet:
+                        print("%s  %s: %s -> %s (%s)" % (when, name, last, status, source))
+                statuses[name] = status
+    finally:
+        pool.terminate()
+    elapsed = time.time() - start
+
+    print("")
+    print("%d documents (%d pages of sites not in '%s' skipped), %d sites, %d transitions" % (len(documents), skipped, args.websitesFile, len(statuses), transitions))
+    print("%.2f seconds, %.0f documents/sec with %d processes" % (elapsed, len(documents) / elapsed if elapsed else 0, args.processes))
@@ -3,26 +3,50 @@
 # standard libraries
 import enum
 import traceback
-import requests
 import signal
 import argparse
-import inspect
 import os
 import time
-import smtplib
 import sys
 import random
-import urllib3
 import syslog
 import json
 import re
-import urllib3
+import html
+import threading
+import importlib
+import concurrent.futures
+import contextlib
+import queue
+import heapq
+import bisect
+import math
+import csv
+import socket
+import glob
+import hashlib
+import sqlite3
+import gzip
+import logging
+import logging.handlers
+import atexit
+import http.server
+import socketserver
+import collections
+import resource
+from urllib.parse import urlsplit
 from datetime import datetime
 from datetime import timedelta
-from email.mime.text import MIMEText
 
-# non-standard libraries
-import schedule 
+# non-standard libraries ('requests') and the larger standard ones ('smtplib', 'asyncio')
+# are imported where they are first used, so the program starts (and writes its first
+# 'status.json') quickly
+
+# optional libraries
+try:
+    import brotli # for 'status.*.br', pre-compressed copies of the rendered status
+except ImportError:
+    brotli = None
 
 PROGRAM_DESCRIPTION="""
     
@@ -38,10 +62,22 @@ PROGRAM_DESCRIPTION="""
     The sites in `websites.json` can be one of four `type` values:
 
     * `phrase` : Looks for the presence or absence of phrases specified by `pos_phrase` or `neg_phrase`.
+      Either can be a single phrase or a list of phrases.  At most `max_bytes` (default 10 MB)
+      of the page are read, for at most `max_time` seconds (default 60); a page over either
+      limit leaves the site stale.
     * `cvs`: Queries the `cvs.com` website with with the `state` and `city` parameters supplied.
+      With `radius` (miles), any CVS within that distance of `city` counts, in whichever
+      states they are; cities are placed with the table passed as --cities.
     * `heb`: Queries the `heb.com` website with with the `query` parameter supplied.
     * `walgreens`: Queries the `walgreens.com` website with with the `query` parameter supplied.
 
+    More types can be added as provider plugins, see 'Provider' and --provider.
+
+    Any site can also set `interval`, how often in seconds it is polled, in place of --request-rate.
+
+    Changes to 'websites.json' are picked up while the program runs (or right away on
+    'kill -HUP'); sites that didn't change keep their status.
+
     If the argument --notification-rate is passed, this program expects a 
     valid 'credentials.json' file specified by the --credentials argument.
     This file should contain the authentication credentials for an SMTP server 
@@ -70,10 +106,26 @@ PROGRAM_DESCRIPTION="""
     # the email supplied in 'credentials.json'
     ./vaccineChecker.py --websites input/websites.json --request-rate 500 --output-dir output --credentials input/credentials.json
 
+    # run the daemon querying up to 50 sites at the same time
+    ./vaccineChecker.py --websites input/websites.json --max-concurrency 50
+
+    # split the sites across worker processes (on this host or others sharing the
+    # '/shared/savaccine' directory); the coordinator alone writes 'status.json'
+    # and sends emails.  Sites are spread over the live workers by consistent
+    # hashing of their names, and a dead worker's sites go to the others.
+    ./vaccineChecker.py --websites input/websites.json --role coordinator --shard-dir /shared/savaccine --credentials input/credentials.json
+    ./vaccineChecker.py --websites input/websites.json --role worker --shard-dir /shared/savaccine --worker-id node1
+
+    # poll from a child process that is started again, from a checkpoint of its
+    # state, whenever it crashes; 'status.json' keeps its last good content meanwhile
+    ./vaccineChecker.py --websites input/websites.json --supervise
+
     REQUIREMENTS:
 
-    This script was developed with Python 3.4.3 and the packages as specified
-    by the import directives.
+    This script was developed with Python 3.4.3 and needs the 'requests' package.
+
+    On startup, the status of each site is carried over from the 'status.json' in
+    --output-dir, which is rewritten right away; changes are only reported against it.
 
     If the 'walgreens' type in 'websites.json' is specified, the 'selenium' Python package
     and the 'geckodriver' OS package is needed.
@@ -89,456 +141,3244 @@ def SignalHandler(sig, frame):
     sys.exit(0)
 
 '''
-Enum class for provider status.
+A supervised worker stops cleanly only on the supervisor's SIGINT.  A SIGTERM from anyone
+else (i.e. 'kill' or the OOM handling of a container) exits non-zero, so the supervisor
+starts another worker rather than taking it for a clean exit.
 '''
-class Availability(enum.Enum):
-    PROBABLY_NOT = "probably not"
-    MAYBE = "maybe"
-    PROBABLY = "probably"
+def WorkerTermHandler(sig, frame):
+    print("WARNING: Worker terminated by signal %d.  Exiting" % (sig))
+    sys.exit(128 + sig)
 
 '''
-Primary class. 
+Log output.  vaccineChecker.DEBUG() builds records on the calling thread and puts them
+on a queue; LOG_LISTENER formats and writes them to standard out and syslog on its own
+thread.  Set up by setup_logging().
 '''
-class vaccineChecker(object):
-
-    ##############################################
-    # to be populated by read of credentials.json
-    EMAIL = ""
-    PASSWORD = ""
-    RECIPIENTS =  []
-    SMTP_HOST = ""
-    SMTP_PORT = 0
-    ##############################################
+LOGGER = logging.getLogger("vaccineChecker")
+LOG_LISTENER = None
+LOG_LEVELS = { "ERROR" : logging.ERROR, "WARNING" : logging.WARNING, "INFO" : logging.INFO, "DEBUG" : logging.DEBUG }
 
-    MIN_REQUEST_RATE = 5 # seconds
-    MAX_ATTEMPTS = 0 # maximum runs of main while loop. 0 = run forever.
-    TIMEOUT = 10 # website access timeout (seconds)
+'''
+Log lines as they always were: '[time] INFO: message', plus the process ID, function
+name and line number when verbose.
+'''
+class TextLogFormatter(logging.Formatter):
 
-    m_attempts = 0 # total runs of main while loop
+    def __init__(self, verbose):
+        logging.Formatter.__init__(self)
+        self.m_verbose = verbose
 
-    # command line arguments
-    m_websitesFile = "" # location of 'websites.json'
-    m_outputDir = "" # the directory were status.json gets written to
-    m_credentialsFile = "" # location of 'credentials.json'
-    m_notificationRate = 0 # how often, in minutes, we should send a emailed notification with script status
-    m_enableArchive = False # whether or not files should be written as archives in m_outputDir
-    m_requestRate = 0 # how often, in seconds, we should ask for website status
-    m_verbose = False # if set to true, prints out function name and process ID when logging
+    def format(self, record):
+        t = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        if self.m_verbose:
+            return "[%s][%s|%s|%s] %s" % (t, record.process, record.funcName, record.lineno, record.msg)
+        return "[%s] %s" % (t, record.msg)
 
-    # initially populated with 'websites.json', but then updated continuously
-    m_websites = {}
+'''
+Log lines as JSON objects, one per line, with the level split out of the message.
+'''
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record):
+        message = record.msg
+        prefix = record.levelname + ": "
+        if message.startswith(prefix):
+            message = message[len(prefix):]
+        return json.dumps({
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)),
+            "level" : record.levelname.lower(),
+            "pid" : record.process,
+            "function" : record.funcName,
+            "line" : record.lineno,
+            "message" : message }, separators=(",", ":"))
 
-    # selenium object for accessing sites that require special navigation
-    m_sd = object()
+'''
+Sends records to the local syslog, as the script always has.
+'''
+class SyslogHandler(logging.Handler):
 
-    '''
-    Setup.
-    '''
-    def __init__(self, websitesFile, outputDir, credentialsFile, notificationRate, enableArchive, requestRate, verbose):
+    PRIORITIES = { logging.ERROR : syslog.LOG_ERR, logging.WARNING : syslog.LOG_WARNING, logging.INFO : syslog.LOG_INFO, logging.DEBUG : syslog.LOG_DEBUG }
 
-        self.DEBUG("INFO: Initializing....")
+    def emit(self, record):
+        try:
+            syslog.syslog(self.PRIORITIES.get(record.levelno, syslog.LOG_INFO), self.format(record))
+        except Exception:
+            self.handleError(record)
 
-        self.m_websitesFile = websitesFile
-        self.m_outputDir = outputDir
-        self.m_credentialsFile = credentialsFile
-        self.m_notificationRate = notificationRate
-        self.m_enableArchive = enableArchive
-        self.m_requestRate = requestRate
-        self.m_verbose = verbose
+'''
+Hands records to the listener thread as they are, without formatting them first.
+'''
+class RecordQueueHandler(logging.handlers.QueueHandler):
 
-        urllib3.disable_warnings() # for ignoring InsecureRequestWarning for https
+    def prepare(self, record):
+        return record
 
-        # if configured, for confirmation things are going ok, send a text/email
-        if (0 != self.m_notificationRate):
-            self.read_credentials()
-            self.DEBUG("INFO: --notification-rate passed, configuring to send heartbeat message every %d minutes" % (self.m_notificationRate))
-            self.heartbeat()
-            schedule.every(self.m_notificationRate).minutes.do(self.heartbeat)
-        else:
-            self.DEBUG("INFO: --notification-rate not passed, no notifications will be sent.")
+'''
+Configure LOGGER once per process.  'level' is one of LOG_LEVELS, 'logFormat' is
+"text" or "json".
+'''
+def setup_logging(verbose, level="INFO", logFormat="text"):
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        return
+
+    formatter = JsonLogFormatter() if "json" == logFormat else TextLogFormatter(verbose)
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setFormatter(formatter)
+    sysLog = SyslogHandler()
+    sysLog.setFormatter(formatter)
+
+    logQueue = queue.Queue()
+    LOGGER.addHandler(RecordQueueHandler(logQueue))
+    LOGGER.setLevel(LOG_LEVELS[level.upper()])
+    LOGGER.propagate = False
+
+    LOG_LISTENER = logging.handlers.QueueListener(logQueue, stdout, sysLog)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop) # write out whatever is still queued
 
-        self.read_websites()
+'''
+Enum class for provider status.
+'''
+class Availability(enum.Enum):
+    PROBABLY_NOT = "probably not"
+    MAYBE = "maybe"
+    PROBABLY = "probably"
 
-        # check for selenium
-        for name, info in self.m_websites.items():
-            site = self.m_websites[name]
-            
-            # currently only Walgreens requires selenium
-            if "walgreens" == site['type'].lower():
-                self.DEBUG("INFO: Setting up Python package 'selenium' for queries requiring user navigation (i.e  Walgreens)...")
-                self.selenium_setup()
+'''
+Cache of decoded provider feeds (i.e. the CVS state feed, the HEB locations feed), keyed
+by URL.  Many sites in 'websites.json' can share one feed, so a feed is fetched and
+indexed once, and every site asking for it within 'maxAge' seconds does a dictionary
+lookup.  Sites are polled at different times (every interval is jittered), so this is
+what keeps a shared feed to one download per polling period rather than one per sweep.
+Safe to use from the query threads.
+'''
+class FeedCache(object):
 
+    def __init__(self):
+        self.m_entries = {} # url -> (time the fetch started, index)
+        self.m_locks = {} # url -> lock held while that feed is being fetched
+        self.m_lock = threading.Lock() # protects m_entries and m_locks
 
     '''
-    Utility function for setting up selenium (needed for navigation on websites).
+    Return the index for 'url', calling load(url) to fetch and build it unless it was
+    fetched less than 'maxAge' seconds ago.  Concurrent callers for the same URL wait
+    for the first one rather than downloading the feed again.
     '''
-    def selenium_setup(self):
+    def get(self, url, load, maxAge):
+        with self.m_lock:
+            entry = self.m_entries.get(url)
+            if entry is not None and time.time() - entry[0] < maxAge:
+                return entry[1]
+            urlLock = self.m_locks.setdefault(url, threading.Lock())
+
+        with urlLock:
+            with self.m_lock:
+                entry = self.m_entries.get(url)
+                if entry is not None and time.time() - entry[0] < maxAge:
+                    return entry[1]
+
+            started = time.time()
+            index = load(url)
+
+            with self.m_lock:
+                self.m_entries[url] = (started, index)
+            return index
 
-        from selenium import webdriver
-        options = webdriver.firefox.options.Options()
-        options.headless = True
-        self.DEBUG("INFO: Creating selenium object...")
+'''
+Matches any number of 'pos_phrase' / 'neg_phrase' phrases against a page in one pass
+while it is being downloaded, skipping HTML comments (outdated information sometimes
+lives there).  All phrases and the comment opener are compiled into a single regular
+expression, so each chunk is scanned once no matter how many phrases a site lists.
+
+Pages are matched as the bytes they arrive as, never decoded: the phrases are encoded
+to the page's charset instead, compiled once per charset seen.  Built once per site,
+then scan() is called for every response.
+'''
+class PhraseMatcher(object):
 
-        # assumes 'geckodriver' binary is in path
-        self.m_sd = webdriver.Firefox(options=options)
-        self.m_sd.set_page_load_timeout(30)
-        self.DEBUG("INFO: Done setting up selenium.")
+    COMMENT_START = "<!--"
+    COMMENT_END = "-->"
 
-    '''
-    Utility function for logging.  Send to standard out and syslog.
-    '''
-    def DEBUG(self, x):
-        if (self.m_verbose):
-            frame,filename,line_number,function_name,lines,index = inspect.stack()[1] 
-            logLine = "[%s][%s|%s|%s] %s\n" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), function_name, line_number, x)
-        else:
-            logLine = "[%s] %s\n" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), x)
+    def __init__(self, posPhrases, negPhrases):
+        self.m_posPhrases = [p for p in posPhrases if p != ""]
+        self.m_negPhrases = [p for p in negPhrases if p != ""]
+        self.m_alwaysNeg = "" in negPhrases # an empty 'neg_phrase' is found in every page
+        self.m_compiled = {} # encoding -> (regex, overlap, comment end)
 
-        sys.stdout.write(logLine)
-        syslog.syslog(logLine)
-   
     '''
-    Read in credentials.json.
+    The regular expression, the number of bytes to keep between chunks so phrases split
+    across two chunks are still found, and the comment closer, all encoded as
+    'encoding'.  Phrases that can't be encoded as 'encoding' are matched as UTF-8.
     '''
-    def read_credentials(self):
+    def compiled(self, encoding):
+        entry = self.m_compiled.get(encoding)
+        if entry is not None:
+            return entry
 
-        filename = self.m_credentialsFile
-        example = ''' 
-{
-"email" : "foo@gmail.com",
-"password" : "bar",
-"recipients" : "foobar@tmomail.net,myname@yahoo.com",
-"smtp_host" : "smtp.myserver.com",
-"smtp_port" : 465
-}
-        '''
-        if (not os.path.exists(filename)):
-            self.DEBUG("ERROR: " + filename + ' file not found, exiting. example file contents: ' + example)
-            sys.exit(-1)
+        def encode(text):
+            try:
+                return text.encode(encoding)
+            except (LookupError, UnicodeError):
+                return text.encode("utf-8")
 
-        try:
-            f = open(filename)
-            c = json.loads(f.read())
-            f.close()
+        posPhrases = [encode(p) for p in self.m_posPhrases]
+        negPhrases = [encode(p) for p in self.m_negPhrases]
+        commentStart = encode(self.COMMENT_START)
 
-            self.EMAIL = c['email']
-            self.PASSWORD = c['password']
-            self.RECIPIENTS = c['recipients']
-            self.SMTP_HOST = c['smtp_host']
-            self.SMTP_PORT = c['smtp_port']
-            self.DEBUG("INFO: Successfully read credentials file.")
-        except Exception as e:
-            self.DEBUG("ERROR: Problem reading file " + filename + '. valid example content: ' + example)
-            self.DEBUG(traceback.format_exc())
-            sys.exit(-1)
+        # longest phrases first so the longest match wins at any one position
+        alternatives = [b"(?P<comment>" + re.escape(commentStart) + b")"]
+        if posPhrases:
+            alternatives.append(b"(?P<pos>" + b"|".join(re.escape(p) for p in sorted(posPhrases, key=len, reverse=True)) + b")")
+        if negPhrases:
+            alternatives.append(b"(?P<neg>" + b"|".join(re.escape(p) for p in sorted(negPhrases, key=len, reverse=True)) + b")")
+        overlap = max([len(p) for p in posPhrases + negPhrases] + [len(commentStart)]) - 1
+
+        entry = self.m_compiled[encoding] = (re.compile(b"|".join(alternatives)), overlap, encode(self.COMMENT_END))
+        return entry
 
     '''
-    Read in websites.json.
+    Scan an iterable of byte chunks of a page encoded as 'encoding'.  Reading stops as
+    soon as the result is decided (a positive phrase was found, or a negative one and
+    the site has no positive phrases), unless 'keepBody' is set, in which case the whole
+    page is read and its chunks are returned as they came.  As in a browser, a comment
+    that is never closed runs to the end of the page.  Returns a tuple of
+    (Availability, list of chunks), the list being empty unless 'keepBody'.
     '''
-    def read_websites(self):
+    def scan(self, chunks, keepBody=False, encoding="utf-8"):
+        regex, overlap, commentEnd = self.compiled(encoding)
+        found = {"pos" : False, "neg" : self.m_alwaysNeg}
+        inComment = False
+        carry = b""
+        body = []
+
+        def decided():
+            return found["pos"] or (found["neg"] and not self.m_posPhrases)
+
+        # scan 'text', only accepting matches that start before 'limit' (i.e. that can't
+        # be cut short by the end of the chunk).  returns the bytes to carry over.
+        def scan_text(text, limit):
+            nonlocal inComment
+            pos = 0
+            while not decided():
+                if inComment:
+                    end = text.find(commentEnd, pos)
+                    if -1 == end:
+                        return text[max(pos, len(text) - (len(commentEnd) - 1)):]
+                    inComment = False
+                    pos = end + len(commentEnd)
+                    continue
+
+                m = regex.search(text, pos)
+                if m is None or m.start() >= limit:
+                    break
+                if "comment" == m.lastgroup:
+                    inComment = True
+                    pos = m.end()
+                else:
+                    found[m.lastgroup] = True
+                    pos = m.start() + 1
+            return text[max(pos, limit):]
+
+        for chunk in chunks:
+            if keepBody:
+                body.append(chunk)
+            if not decided():
+                text = carry + chunk
+                carry = scan_text(text, len(text) - overlap)
+            if decided() and not keepBody:
+                break
+        else:
+            scan_text(carry, len(carry))
 
-        filename = self.m_websitesFile
-        example = ''' 
-{
-    "name": "UT Health San Antonio",
-    "type" : "phrase",
-    "website": "https://schedule.utmedicinesa.com/Identity/Account/Register",
-    "neg_phrase": "are full",
-    "pos_phrase": "you confirm your understanding",
-}
-        '''
-        if (not os.path.exists(filename)):
-            self.DEBUG("ERROR: " + filename + ' file not found, exiting. example file contents: ' + example)
-            sys.exit(-1)
+        if found["pos"]:
+            status = Availability.PROBABLY
+        elif found["neg"]:
+            status = Availability.PROBABLY_NOT
+        else:
+            status = Availability.MAYBE
+        return status, body
 
-        try:
-            f = open(filename)
-            self.m_websites = json.loads(f.read())
+'''
+A selenium browser handed out by BrowserPool.  'screened' is set once the browser
+has clicked through the Walgreens landing page, so later queries can go straight to
+the location screening page.
+'''
+class PooledBrowser(object):
 
-            # initialize things the user doesn't supply
-            for name, info in self.m_websites.items():
-                site = self.m_websites[name]
-                if "type" not in site:
-                    self.DEBUG("ERROR: Each site in 'websites.json' must have a 'type'.  See README.md")
-                    sys.exit(-1)
-                if "status" not in site:
-                    site["status"] =  Availability.PROBABLY_NOT.value
-                if "update_time" not in site:
-                    site["update_time"] = ""
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+        self.screened = False
 
-            f.close()
-        except Exception as e:
-            self.DEBUG("ERROR: Problem reading file " + filename + '. valid example content: ' + example)
-            self.DEBUG(traceback.format_exc())
-            sys.exit(-1)
+'''
+A bounded pool of headless browsers for sites that need navigation.  Browsers are
+created on demand up to 'size', health checked before being handed out, recycled
+after 'maxUses' queries, and quit (never just dropped) when they fail or the pool is
+closed.
+'''
+class BrowserPool(object):
+
+    def __init__(self, create, size, maxUses, log):
+        self.m_create = create # returns a new selenium driver
+        self.m_size = size
+        self.m_maxUses = maxUses
+        self.m_log = log
+        self.m_idle = queue.Queue()
+        self.m_count = 0 # browsers in existence, idle or in use
+        self.m_lock = threading.Lock()
+        self.m_closed = False
 
     '''
-    Given a string, logs it.  If notifications are enabled, it sends an email to RECIPIENTS,
-    using the credentials in EMAIL and PASSWORD.
+    Check out a browser for the duration of a 'with' block.  If the block raises, the
+    browser is assumed to be in a bad state and is replaced.
     '''
-    def send_message(self, s):
-
-        self.DEBUG(s)
+    @contextlib.contextmanager
+    def browser(self):
+        b = self.acquire()
+        try:
+            yield b
+        except BaseException:
+            self.m_log("INFO: Resetting selenium...")
+            self.discard(b)
+            raise
+        self.release(b)
+
+    def acquire(self):
+        while True:
+            with self.m_lock:
+                if self.m_closed:
+                    raise RuntimeError("browser pool is closed")
+                create = self.m_idle.empty() and self.m_count < self.m_size
+                if create:
+                    self.m_count += 1
+
+            if create:
+                try:
+                    return PooledBrowser(self.m_create())
+                except BaseException:
+                    with self.m_lock:
+                        self.m_count -= 1
+                    raise
 
-        if (self.m_notificationRate == 0):
+            try:
+                b = self.m_idle.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self.healthy(b):
+                return b
+            self.m_log("WARNING: Browser failed health check, replacing it")
+            self.discard(b)
+
+    def release(self, b):
+        b.uses += 1
+        if b.uses >= self.m_maxUses:
+            self.m_log("INFO: Recycling browser after %d uses" % (b.uses))
+            self.discard(b)
             return
-
-        if (self.m_verbose):
-            frame,filename,line_number,function_name,lines,index = inspect.stack()[1] 
-            m = "[%s]\n[%s|%s|%s]\n%s\n%s\n" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), function_name, line_number, s, "http://sanantoniovaccine.com")
+        with self.m_lock:
+            closed = self.m_closed
+        if closed:
+            self.discard(b)
         else:
-            m = "[%s]\n%s" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), s)
+            self.m_idle.put(b)
+
+    def healthy(self, b):
+        try:
+            b.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def discard(self, b):
+        with self.m_lock:
+            self.m_count -= 1
+        try:
+            b.driver.quit()
+        except Exception:
+            pass
+
+    '''
+    Quit every idle browser.  Browsers still in use are quit when they are released.
+    '''
+    def close(self):
+        with self.m_lock:
+            self.m_closed = True
+        while True:
+            try:
+                b = self.m_idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(b)
 
-        msg = MIMEText(m)
-        msg['Subject'] = os.path.basename(__file__) # script name
-        msg['From'] = self.EMAIL
-        msg['To'] = (', ').join(self.RECIPIENTS.split(','))
+'''
+Decides when each site is polled next.  Sites sit in a priority queue ordered by their
+next due time, each with its own base interval ('interval' in 'websites.json', or
+--request-rate), adjusted after every poll:
+
+* right after a site changes to MAYBE / PROBABLY, it's polled FAST_FACTOR as often
+  for FAST_PERIOD seconds, so real availability is confirmed (or refuted) sooner
+* every consecutive timeout or error doubles the interval, up to MAX_INTERVAL; a poll
+  skipped because the host's circuit breaker is open isn't an error, it's retried when
+  the circuit lets a request through again
+* a site whose status hasn't changed in QUIET_AFTER seconds is polled half as often,
+  and half as often again for each further QUIET_AFTER, up to QUIET_MAX_FACTOR
+'''
+class SiteScheduler(object):
 
-        self.DEBUG("INFO: Attempting to send email with '%s'..." % (s))
-        server = smtplib.SMTP_SSL(self.SMTP_HOST, self.SMTP_PORT)
-        server.login(self.EMAIL, self.PASSWORD)
-        server.sendmail(self.EMAIL, self.RECIPIENTS.split(','), str(msg))
-        server.quit()
-        self.DEBUG("INFO: Successfully sent email to '%s'!" % self.RECIPIENTS)
+    FAST_FACTOR = 0.25
+    FAST_PERIOD = 30 * 60 # seconds
+    MAX_INTERVAL = 60 * 60 # seconds, unless a site's own interval is longer
+    QUIET_AFTER = 2 * 60 * 60 # seconds
+    QUIET_MAX_FACTOR = 4
 
+    def __init__(self, minInterval, variance):
+        self.m_minInterval = minInterval
+        self.m_variance = variance # up to this many seconds of jitter are added to every interval
+        self.m_heap = [] # (due time, sequence number, site name)
+        self.m_sites = {} # site name -> dict of scheduling state
+        self.m_sequence = 0
 
     '''
-    Utility function to let someone know the script is running a-ok.
+    Start scheduling 'name', due immediately.
     '''
-    def heartbeat(self):
-        self.send_message("INFO: Heartbeat. m_attempts = '%d'." % (self.m_attempts))
+    def add(self, name, interval, now):
+        self.m_sites[name] = { "interval" : interval, "failures" : 0, "last_change" : now, "fast" : False }
+        self.push(name, now)
 
     '''
-    Handle when a website status changes (i.e. from Availability.PROBABLY_NOT to Availability.MAYBE)
+    Stop scheduling 'name'.  Its entry left in the queue is skipped when it comes up.
     '''
-    def handle_status(self, status, name, html):
+    def remove(self, name):
+        self.m_sites.pop(name, None)
 
-        site = self.m_websites[name]
-        if status.value != site['status']:
-            self.send_message("INFO: %s (%s) changed to %s" % (name, site['website'], status))
+    def push(self, name, due):
+        self.m_sequence += 1
+        self.m_sites[name]["sequence"] = self.m_sequence
+        self.m_sites[name]["due"] = due
+        heapq.heappush(self.m_heap, (due, self.m_sequence, name))
 
-            # save off HTML if passed 
-            if "" != html and self.m_enableArchive:
-                archive_dir = self.m_outputDir + "/archive"
-                if (not os.path.exists(archive_dir)):
-                    os.makedirs(archive_dir)
-                filename = archive_dir + "/" + name + ".html." + (datetime.now().strftime("%Y-%m-%d_%H%M%S"))
-                f = open(filename, "w")
-                f.write(html)
-                f.close()
-                self.DEBUG("INFO: Archiving file '%s'" % (filename))
-        else:
-            self.DEBUG("INFO: still %s for %s" % (status, name))
+    '''
+    The scheduling state of 'name' (when it is next due, failures in a row, last status
+    change) as a dict for a checkpoint, or None if it isn't scheduled.
+    '''
+    def snapshot(self, name):
+        state = self.m_sites.get(name)
+        if state is None:
+            return None
+        return { "due" : state["due"], "failures" : state["failures"], "last_change" : state["last_change"], "fast" : state["fast"] }
 
-        site['status'] = status.value
+    '''
+    Put back the scheduling state 'saved' by snapshot() for 'name', which must have been
+    add()ed.  A site that was due (or being polled) when the snapshot was taken is due
+    immediately.
+    '''
+    def restore(self, name, saved):
+        state = self.m_sites.get(name)
+        if state is None:
+            return
+        state["failures"] = saved["failures"]
+        state["last_change"] = saved["last_change"]
+        state["fast"] = saved["fast"]
+        self.push(name, saved["due"])
 
     '''
-    For querying the Walgreens page for availability.  Requires 'selenium' to be installed.
+    Remove and return the names of all sites due at or before 'now'.
     '''
-    def query_walgreens(self, name):
-        from selenium.common.exceptions import NoSuchElementException
+    def pop_due(self, now):
+        names = []
+        while self.m_heap and self.m_heap[0][0] <= now:
+            due, sequence, name = heapq.heappop(self.m_heap)
+            state = self.m_sites.get(name)
+            if state is not None and state["sequence"] == sequence:
+                names.append(name)
+        return names
 
-        site = self.m_websites[name]
+    '''
+    Time the next site is due, or None if nothing is scheduled.
+    '''
+    def next_due(self):
+        while self.m_heap:
+            due, sequence, name = self.m_heap[0]
+            state = self.m_sites.get(name)
+            if state is not None and state["sequence"] == sequence:
+                return due
+            heapq.heappop(self.m_heap)
+        return None
 
-        s = "https://www.walgreens.com/findcare/vaccination/covid-19"
-        self.DEBUG("INFO: Requesting site '%s'" % (s))
-        self.m_sd.get(s)
-        btn = self.m_sd.find_element_by_css_selector('span.btn.btn__blue')
-        btn.click()
-        s = "https://www.walgreens.com/findcare/vaccination/covid-19/location-screening"
-        self.DEBUG("INFO: Requesting site '%s'" % (s))
-        self.m_sd.get(s)
-        element = self.m_sd.find_element_by_id("inputLocation")
-        element.clear()
-
-        q = site['query']
-        self.DEBUG("INFO: Asking Walgreens about the location '%s'" % (q))
-        element.send_keys(q)
-        button = self.m_sd.find_element_by_css_selector("button.btn")
-        button.click()
-        time.sleep(0.75)
-
-        timeout = time.time() + 30 # 30 sec timeout
-        self.DEBUG("INFO: Waiting for Walgreens result...")
-        response = object()
-        while True:
-            if (time.time() > timeout):
-                self.DEBUG("WARNING: Timeout waiting for Walgreens result, continuing")
-            try:
-                response = self.m_sd.find_element_by_css_selector("p.fs16")
-                break
-            except NoSuchElementException:
-                time.sleep(0.5)
-
-        self.DEBUG("INFO: Found Walgreens result '%s'" % (response.text))
-        if "Appointments unavailable" == response.text:
-            self.handle_status(Availability.PROBABLY_NOT, name, "")
-        elif "Please enter a valid city and state or ZIP" == response.text:
-            self.handle_status(Availability.PROBABLY_NOT, name, "")
-        else:
-            self.handle_status(Availability.MAYBE, name, "")
+    '''
+    Reschedule 'name' after a successful poll that found 'status'.
+    '''
+    def record_success(self, name, status, changed, now):
+        state = self.m_sites.get(name)
+        if state is None:
+            return
+        state["failures"] = 0
+        if changed:
+            state["last_change"] = now
+            state["fast"] = status in (Availability.MAYBE, Availability.PROBABLY)
+        self.push(name, now + self.interval(state, now))
 
     '''
-    For querying the CVS page for availability.
+    Reschedule 'name' after a poll that timed out or failed.
     '''
-    def query_cvs(self, name):
+    def record_failure(self, name, now):
+        state = self.m_sites.get(name)
+        if state is None:
+            return
+        state["failures"] += 1
+        self.push(name, now + self.interval(state, now))
 
-        self.DEBUG("INFO: Requesting information from CVS...")
-        site = self.m_websites[name]
+    '''
+    Reschedule 'name' after a poll skipped because its host's circuit is open: at
+    'retryAt', when the host may be asked again, or after the usual interval if that
+    has passed.  A skip isn't a failure of the site, so it doesn't back the site off.
+    '''
+    def record_skip(self, name, retryAt, now):
+        state = self.m_sites.get(name)
+        if state is None:
+            return
+        self.push(name, retryAt if retryAt > now else now + self.interval(state, now))
 
-        state = site['state']
-        city = site['city']
-        response = requests.get("https://www.cvs.com/immunizations/covid-19-vaccine.vaccine-status.{}.json?vaccineinfo".format(state.lower()), headers={"Referer":"https://www.cvs.com/immunizations/covid-19-vaccine"})
-        payload = response.json()
+    '''
+    Seconds between polls of 'name' at the moment, without the jitter, or None if it
+    isn't scheduled.
+    '''
+    def period(self, name, now):
+        state = self.m_sites.get(name)
+        if state is None:
+            return None
+        return max(self.m_minInterval, self.base_interval(state, now))
+
+    def interval(self, state, now):
+        interval = self.base_interval(state, now)
+        interval += random.uniform(-self.m_variance, self.m_variance)
+        return max(self.m_minInterval, interval)
+
+    def base_interval(self, state, now):
+        interval = state["interval"]
+        unchanged = now - state["last_change"]
+
+        if state["failures"]:
+            interval *= 2 ** min(state["failures"], 16)
+        elif state["fast"] and unchanged < self.FAST_PERIOD:
+            interval *= self.FAST_FACTOR
+        elif unchanged >= self.QUIET_AFTER:
+            interval *= min(self.QUIET_MAX_FACTOR, 2 ** int(unchanged // self.QUIET_AFTER))
+
+        return min(interval, max(self.MAX_INTERVAL, state["interval"]))
 
-        self.DEBUG("INFO: Received response, parsing information from CVS...")
-        mappings = {}
-        try:
-            for item in payload["responsePayloadData"]["data"][state]:
-                mappings[item.get('city')] = item.get('status')
+'''
+Content-addressed archive of page HTML and 'status.json' snapshots.  Each distinct
+document is stored once, gzip compressed, as 'blobs/<hash[:2]>/<hash[2:]>.gz' (keyed by
+its SHA-256), and every new version is recorded as one line of (time, site, kind,
+blob hash) in an append-only index.  The index is split into segment files that are
+rotated once they reach SEGMENT_MAX_BYTES.  Disk and inode use grow with the number
+of distinct page versions, not with the number of polls.
+
+If 'retentionDays' is non-zero, segments last written more than that many days ago
+are deleted once a day, along with blobs no remaining segment refers to.
+'''
+class ArchiveStore(object):
+
+    SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+    PRUNE_INTERVAL = 24 * 60 * 60 # seconds
+
+    def __init__(self, directory, retentionDays, log):
+        self.m_dir = directory
+        self.m_blobDir = directory + "/blobs"
+        self.m_indexDir = directory + "/index"
+        self.m_retention = retentionDays * 24 * 60 * 60 # seconds
+        self.m_log = log
+        self.m_lastPrune = 0
+        self.m_latest = {} # (site, kind) -> hash of the last version archived
+        for d in (self.m_blobDir, self.m_indexDir):
+            if (not os.path.exists(d)):
+                os.makedirs(d)
+
+    def blob_path(self, blobHash):
+        return "%s/%s/%s.gz" % (self.m_blobDir, blobHash[:2], blobHash[2:])
 
-            response = mappings[city.upper()]
+    '''
+    Archive 'content' (a string, or a list of byte chunks such as a page as it was
+    downloaded) as the current version of 'kind' ("html" or "status") for 'site'.
+    Chunks are hashed and written as they are, without joining them into one copy.
+    Returns the blob hash.
+    '''
+    def put(self, site, kind, content):
+        chunks = [content.encode("utf-8")] if isinstance(content, str) else content
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+        blobHash = digest.hexdigest()
+        if self.m_latest.get((site, kind)) == blobHash:
+            return blobHash # same as the version archived last, nothing new to record
+
+        path = self.blob_path(blobHash)
+        if (not os.path.exists(path)):
+            d = os.path.dirname(path)
+            if (not os.path.exists(d)):
+                os.makedirs(d)
+            f = gzip.open(path + ".tmp", "wb")
+            for chunk in chunks:
+                f.write(memoryview(chunk))
+            f.close()
+            os.replace(path + ".tmp", path)
 
-            if ("Fully Booked" == response):
-                self.handle_status(Availability.PROBABLY_NOT, name, "")
-                self.DEBUG("INFO: Found 'fully booked'")
-            else:
-                self.handle_status(Availability.MAYBE, name, "")
+        record = { "time" : datetime.now().strftime("%Y-%m-%d_%H%M%S"), "site" : site, "kind" : kind, "blob" : blobHash }
+        f = open(self.current_segment(), "a")
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        f.close()
+        self.m_latest[(site, kind)] = blobHash
 
-        except KeyError as e:
-            self.handle_status(Availability.PROBABLY_NOT, name, "")
-            self.DEBUG("WARNING: Could not find state '%s' or city '%s' in CVS response" % (state, city))
+        if self.m_retention and time.time() - self.m_lastPrune > self.PRUNE_INTERVAL:
+            self.prune()
+        return blobHash
 
     '''
-    For querying the HEB page for availability.
+    Return the content of the blob 'blobHash' as bytes (pages are kept in the encoding
+    they were served in).
     '''
-    def query_heb(self, name):
-
-        self.DEBUG("INFO: Requesting information from HEB...")
-        site = self.m_websites[name]
+    def get(self, blobHash):
+        f = gzip.open(self.blob_path(blobHash), "rb")
+        data = f.read()
+        f.close()
+        return data
 
-        d = requests.get("http://heb-ecom-covid-vaccine.hebdigital-prd.com/vaccine_locations.json").json()
+    def segments(self):
+        return sorted(self.m_indexDir + "/" + f for f in os.listdir(self.m_indexDir) if f.endswith(".jsonl"))
 
-        self.DEBUG("INFO: Received response, parsing information from HEB...")
-        city = site['city'].upper()
-        try:
-            foundOne = False
-            for location in d['locations']:
-                if location["city"].upper() == city and location["openTimeslots"] != 0:
-                    self.DEBUG("INFO: Found a match at HEB for '%s'! Zip code: '%s'. Open timeslots: %d" % (city, location['zip'], location['openTimeslots']))
-                    self.handle_status(Availability.MAYBE, name, "")
-                    foundOne = True
-            
-            if not foundOne:
-                self.handle_status(Availability.PROBABLY_NOT, name, "")
-
-        except KeyError as e:
-            self.handle_status(Availability.PROBABLY_NOT, name, "")
-            self.DEBUG("WARNING: Could not find city '%s' in HEB response" % (city))
+    def current_segment(self):
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.SEGMENT_MAX_BYTES:
+            return segments[-1]
+        return self.m_indexDir + "/index." + datetime.now().strftime("%Y-%m-%d_%H%M%S.%f") + ".jsonl"
 
+    '''
+    Iterate over every index record, oldest first.
+    '''
+    def entries(self):
+        for segment in self.segments():
+            f = open(segment)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            f.close()
 
     '''
-    primary loop.  query the self.m_websites and keep track of status.
+    Apply the retention policy.
     '''
-    def run(self):
+    def prune(self):
+        self.m_lastPrune = time.time()
+        cutoff = self.m_lastPrune - self.m_retention
+        segments = self.segments()
+        for segment in segments[:-1]: # never the one being appended to
+            if os.path.getmtime(segment) < cutoff:
+                self.m_log("INFO: Removing archive index segment '%s'" % (segment))
+                os.remove(segment)
+
+        referenced = set(record["blob"] for record in self.entries())
+        removed = 0
+        for sub in os.listdir(self.m_blobDir):
+            for blob in os.listdir(self.m_blobDir + "/" + sub):
+                if blob.endswith(".gz") and (sub + blob[:-3]) not in referenced:
+                    os.remove(self.m_blobDir + "/" + sub + "/" + blob)
+                    removed += 1
+        self.m_log("INFO: Removed %d unreferenced archive blobs" % (removed))
+
+        # a version that is gone has to be archived again the next time it comes up
+        self.m_latest = dict((key, blobHash) for key, blobHash in self.m_latest.items() if blobHash in referenced)
 
-        # primary loop
-        while self.m_attempts < self.MAX_ATTEMPTS or self.MAX_ATTEMPTS == 0:
+'''
+History of every poll result (site, time, status, latency) and every status
+transition, in an SQLite database in WAL mode so readers (i.e. 'history.py') never
+block the daemon.  Both tables are indexed by site and time, so questions like "when
+did this site last go MAYBE" or "availability per hour" are answered from the
+indexes.  Writes are batched, one transaction per sweep (see commit()).
 
-            for name, info in self.m_websites.items():
-                site = self.m_websites[name]
-                try:
-                    # special cases that require website navigation
-                    if ("walgreens" == site['type'].lower()):
-                        self.query_walgreens(name)
-                    elif ("cvs" == site['type'].lower()):
-                        self.query_cvs(name)
-                    elif ("heb"  == site['type'].lower()):
-                        self.query_heb(name)
-                    # regular case of looking at a confirmation/absence of phrase in HTML via use
-                    # of 'pos_phrase' / 'neg_phrase'
-                    elif ("phrase" == site['type'].lower()):
-                        self.DEBUG("INFO: asking %s at %s ..." % (name, info['website']))
-                        r = requests.get(site['website'], timeout=self.TIMEOUT, verify=False)
-                        html = re.sub("(<!--.*?-->)", "", r.text, flags=re.DOTALL) # remove HTML comments, outdated information sometimes lives here
-
-                        if site['pos_phrase'] != "" and site['pos_phrase'] in html:
-                            self.handle_status(Availability.PROBABLY, name, html)
-                        elif site['neg_phrase'] in html:
-                            self.handle_status(Availability.PROBABLY_NOT, name, html)
-                        else:
-                            self.handle_status(Availability.MAYBE, name, html)
-                    else:
-                        self.DEBUG("WARNING: Type '%s' for website '%s' not found, skipping..." % (site['type'], site['website']))
-                        continue
-
-                    site['update_time'] = time.strftime("%d-%b-%Y %I:%M:%S %p")
-                except Exception as e:
-                    if isinstance(e, requests.exceptions.Timeout):
-                        self.DEBUG("WARNING: Timeout: " + str(e) + "...continuing")
-                        continue
-                    else:
+Times are seconds since the epoch.  A poll that failed has a NULL status.
+'''
+class HistoryStore(object):
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS polls (site TEXT NOT NULL, time REAL NOT NULL, status TEXT, latency REAL);
+        CREATE INDEX IF NOT EXISTS polls_site_time ON polls (site, time);
+        CREATE INDEX IF NOT EXISTS polls_site_status_time ON polls (site, status, time);
+        CREATE TABLE IF NOT EXISTS transitions (site TEXT NOT NULL, time REAL NOT NULL, old_status TEXT, new_status TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS transitions_site_status_time ON transitions (site, new_status, time);
+    '''
+    AVAILABLE = (Availability.MAYBE.value, Availability.PROBABLY.value)
 
-                        self.DEBUG(traceback.format_exc())
-                        self.DEBUG(("ERROR: Error when querying '%s'. Error type %s : %s" % (name, type(e).__name__, str(e))))
+    def __init__(self, filename):
+        self.m_filename = filename
+        self.m_db = sqlite3.connect(filename)
+        self.m_db.execute("PRAGMA journal_mode=WAL")
+        self.m_db.execute("PRAGMA synchronous=NORMAL")
+        self.m_db.executescript(self.SCHEMA)
 
-                        # currently only Walgreens requires selenium
-                        if (site['type'].lower() == "walgreens"):
-                            self.DEBUG("INFO: Resetting selenium...");
-                            self.selenium_setup() 
+    def record_poll(self, site, when, status, latency):
+        self.m_db.execute("INSERT INTO polls VALUES (?, ?, ?, ?)", (site, when, status, latency))
 
-                        continue
+    def record_transition(self, site, when, oldStatus, newStatus):
+        self.m_db.execute("INSERT INTO transitions VALUES (?, ?, ?, ?)", (site, when, oldStatus, newStatus))
 
-                    self.handle_status(Availability.PROBABLY_NOT, name, "")
-    
-            try:
+    def commit(self):
+        self.m_db.commit()
 
-                # populate the file we use for communication with PHP
-                if (not os.path.exists(self.m_outputDir)):
-                    os.makedirs(self.m_outputDir)
-                STATUS_JSON_FILENAME = "status.json" 
-                filename = self.m_outputDir + "/" + STATUS_JSON_FILENAME
-                content = json.dumps(self.m_websites, indent=4)
-                f = open(filename, "w")
-                f.write(content)
-                f.close()
-                self.DEBUG("INFO: Wrote '%s'" % (filename))
-
-                # save off all that we make
-                if self.m_enableArchive:
-                    archive_dir = self.m_outputDir + "/archive"
-                    if (not os.path.exists(archive_dir)):
-                        os.makedirs(archive_dir)
-                    filename = archive_dir + "/" + STATUS_JSON_FILENAME + "." + (datetime.now().strftime("%Y-%m-%d_%H%M%S"))
-                    f = open(filename, "w")
-                    f.write(content)
-                    f.close()
-                    self.DEBUG("INFO: Archiving file %s" % (filename))
-                
-                # give the good servers some time to rest
-                VARIANCE = 10 # seconds
-                sleeptime = random.randint(max(self.MIN_REQUEST_RATE, self.m_requestRate - VARIANCE), self.m_requestRate + VARIANCE)
-                self.DEBUG("INFO: checking again in %d seconds (%s)..." % (sleeptime, timedelta(seconds=sleeptime)))
-                time.sleep(sleeptime)
+    def close(self):
+        self.m_db.commit()
+        self.m_db.close()
 
-                schedule.run_pending()
-                self.m_attempts += 1
+    '''
+    Returns the sites with history, as (site, number of polls, time of the last poll).
+    '''
+    def sites(self):
+        return self.m_db.execute("SELECT site, COUNT(*), MAX(time) FROM polls GROUP BY site ORDER BY site").fetchall()
 
-            except Exception as e:
-                self.DEBUG(traceback.format_exc())
-                self.send_message("Error during processing of type %s : %s ... exiting." % (type(e).__name__, str(e)))
-                sys.exit(-1)
-        
-        self.DEBUG("INFO: All done.  Bye!")
+    '''
+    Returns the last time 'site' changed to 'status', or None if it never did.
+    '''
+    def last_transition(self, site, status):
+        return self.m_db.execute("SELECT MAX(time) FROM transitions WHERE site = ? AND new_status = ?", (site, status)).fetchone()[0]
 
+    '''
+    Returns the last time 'site' was polled with 'status', or None if it never was.
+    '''
+    def last_seen(self, site, status):
+        return self.m_db.execute("SELECT MAX(time) FROM polls WHERE site = ? AND status = ?", (site, status)).fetchone()[0]
 
-if __name__ == "__main__":
+    '''
+    Returns (start of the hour, polls, percentage of them MAYBE or PROBABLY) for each
+    hour 'site' was polled in since 'since', oldest first.  Failed polls don't count.
+    '''
+    def hourly_availability(self, site, since):
+        rows = self.m_db.execute('''
+            SELECT CAST(time / 3600 AS INTEGER) * 3600 AS hour, COUNT(*), SUM(status IN (?, ?))
+            FROM polls WHERE site = ? AND time >= ? AND status IS NOT NULL
+            GROUP BY hour ORDER BY hour''', self.AVAILABLE + (site, since)).fetchall()
+        return [(hour, polls, 100.0 * available / polls) for hour, polls, available in rows]
 
-    signal.signal(signal.SIGINT, SignalHandler)
+'''
+Sends notification emails from a background thread, so polling never waits on the
+SMTP server.  Messages arriving within 'window' seconds of each other are sent as
+one digest, over an SMTP connection that is kept logged in between digests.  Failed
+sends are retried with exponential backoff, reconnecting each time.
+'''
+class Notifier(object):
+
+    RETRIES = 5
+    MAX_BACKOFF = 300 # seconds
+    SMTP_TIMEOUT = 30 # seconds
+
+    def __init__(self, host, port, email, password, recipients, window, subject, log):
+        self.m_host = host
+        self.m_port = port
+        self.m_email = email
+        self.m_password = password
+        self.m_recipients = recipients # list of addresses
+        self.m_window = window
+        self.m_subject = subject
+        self.m_log = log
+        self.m_server = None # logged in smtplib.SMTP_SSL, or None
+        self.m_queue = queue.Queue() # message text, or None to stop
+        self.m_thread = threading.Thread(target=self.loop, name="notifier")
+        self.m_thread.daemon = True
+        self.m_thread.start()
 
-    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    '''
+    Queue 'text' to be emailed.  Returns immediately.
+    '''
+    def send(self, text):
+        self.m_queue.put(text)
 
-    parser.add_argument(
+    '''
+    Send whatever is still queued and stop, waiting up to 'timeout' seconds.
+    '''
+    def close(self, timeout=SMTP_TIMEOUT):
+        self.m_queue.put(None)
+        self.m_thread.join(timeout)
+
+    def loop(self):
+        closing = False
+        while not closing:
+            first = self.m_queue.get()
+            if first is None:
+                break
+
+            # gather everything else that shows up within the window
+            batch = [first]
+            deadline = time.time() + self.m_window
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    text = self.m_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if text is None:
+                    closing = True
+                    break
+                batch.append(text)
+
+            self.deliver(batch)
+        self.disconnect()
+
+    def deliver(self, batch):
+        if 1 == len(batch):
+            body = batch[0]
+        else:
+            body = ("%d updates:\n\n" % (len(batch))) + "\n\n".join(batch)
+
+        from email.mime.text import MIMEText
+        msg = MIMEText(body)
+        msg['Subject'] = self.m_subject
+        msg['From'] = self.m_email
+        msg['To'] = (', ').join(self.m_recipients)
+
+        backoff = 1
+        for attempt in range(1, self.RETRIES + 1):
+            try:
+                self.m_log("INFO: Attempting to send email with %d message(s)..." % (len(batch)))
+                self.connection().sendmail(self.m_email, self.m_recipients, str(msg))
+                self.m_log("INFO: Successfully sent email to '%s'!" % (', '.join(self.m_recipients)))
+                return
+            except Exception as e:
+                self.m_log("WARNING: Sending email failed (attempt %d of %d). Error type %s : %s" % (attempt, self.RETRIES, type(e).__name__, str(e)))
+                self.disconnect()
+                if attempt < self.RETRIES:
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+        self.m_log("ERROR: Giving up on email with %d message(s)" % (len(batch)))
+
+    '''
+    Return the logged in SMTP connection, reconnecting if the server dropped it.
+    '''
+    def connection(self):
+        if self.m_server is not None:
+            try:
+                if 250 == self.m_server.noop()[0]:
+                    return self.m_server
+            except Exception:
+                pass
+            self.disconnect()
+
+        import smtplib
+        server = smtplib.SMTP_SSL(self.m_host, self.m_port, timeout=self.SMTP_TIMEOUT)
+        server.login(self.m_email, self.m_password)
+        self.m_server = server
+        return server
+
+    def disconnect(self):
+        if self.m_server is not None:
+            try:
+                self.m_server.quit()
+            except Exception:
+                pass
+            self.m_server = None
+
+'''
+Counters, gauges and histograms describing how polling is going, rendered in the
+Prometheus text exposition format.  Every metric is declared in DEFINITIONS; samples
+are keyed by metric name and a dict of labels.  Safe to update from any thread.
+'''
+class Metrics(object):
+
+    DEFINITIONS = {
+        "vaccinechecker_request_duration_seconds" : ("histogram", "Time taken to query a site."),
+        "vaccinechecker_response_bytes_total" : ("counter", "Bytes downloaded, per site or shared feed."),
+        "vaccinechecker_http_responses_total" : ("counter", "HTTP responses, per site or shared feed and status code."),
+        "vaccinechecker_timeouts_total" : ("counter", "Site queries that timed out."),
+        "vaccinechecker_errors_total" : ("counter", "Site queries that failed, by exception type."),
+        "vaccinechecker_last_success_timestamp_seconds" : ("gauge", "Unix time of the last successful update of a site."),
+        "vaccinechecker_seconds_since_last_success" : ("gauge", "Seconds since the last successful update of a site."),
+        "vaccinechecker_status_transitions_total" : ("counter", "Status changes of a site, by new status."),
+        "vaccinechecker_sweep_duration_seconds" : ("histogram", "Time taken to query every site due at once."),
+        "vaccinechecker_status_write_duration_seconds" : ("histogram", "Time taken to write 'status.json'."),
+        "vaccinechecker_sweeps_total" : ("counter", "Runs of the main loop that queried sites."),
+        "vaccinechecker_circuit_open" : ("gauge", "1 if the circuit breaker for a provider host is open or half open, else 0."),
+        "vaccinechecker_circuit_skips_total" : ("counter", "Site queries skipped because the circuit breaker of the site's host was open."),
+        "vaccinechecker_span_duration_seconds" : ("histogram", "Time spent in each profiled span (--profile)."),
+    }
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.m_lock = threading.Lock()
+        self.m_values = {} # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def inc(self, name, labels=None, amount=1):
+        key = self.key(name, labels)
+        with self.m_lock:
+            self.m_values[key] = self.m_values.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        key = self.key(name, labels)
+        with self.m_lock:
+            self.m_values[key] = value
+
+    def observe(self, name, labels, value):
+        key = self.key(name, labels)
+        with self.m_lock:
+            h = self.m_values.get(key)
+            if h is None:
+                h = self.m_values[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    '''
+    Return all metrics in the Prometheus text exposition format.
+    '''
+    def render(self):
+        now = time.time()
+        with self.m_lock:
+            for (name, labels), value in list(self.m_values.items()):
+                if "vaccinechecker_last_success_timestamp_seconds" == name:
+                    self.m_values[("vaccinechecker_seconds_since_last_success", labels)] = now - value
+            values = sorted(self.m_values.items(), key=lambda item: item[0])
+            values = [(k, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v) for k, v in values]
+
+        lines = []
+        declared = set()
+        for (name, labels), value in values:
+            kind, description = self.DEFINITIONS[name]
+            if name not in declared:
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                declared.add(name)
+            if "histogram" == kind:
+                for bound, count in zip(self.BUCKETS, value[0]):
+                    lines.append("%s_bucket%s %d" % (name, self.format_labels(labels + (("le", repr(float(bound))),)), count))
+                lines.append("%s_bucket%s %d" % (name, self.format_labels(labels + (("le", "+Inf"),)), value[2]))
+                lines.append("%s_sum%s %s" % (name, self.format_labels(labels), repr(float(value[1]))))
+                lines.append("%s_count%s %d" % (name, self.format_labels(labels), value[2]))
+            else:
+                lines.append("%s%s %s" % (name, self.format_labels(labels), repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def format_labels(self, labels):
+        if not labels:
+            return ""
+        escaped = []
+        for k, v in labels:
+            v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            escaped.append('%s="%s"' % (k, v))
+        return "{" + ",".join(escaped) + "}"
+
+'''
+Serves Metrics.render() over HTTP for Prometheus to scrape.
+'''
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        self.m_metrics = metrics
+        http.server.HTTPServer.__init__(self, address, MetricsRequestHandler)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.m_metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes would flood the log
+
+'''
+Timing spans for --profile.  span(name) times a block of code, from any thread; the
+calls, total and longest time of each span name are kept for the current cycle and
+handed back (and reset) by end_cycle().  Every span is also observed in Metrics.
+'''
+class Profiler(object):
+
+    def __init__(self, metrics):
+        self.m_metrics = metrics
+        self.m_lock = threading.Lock()
+        self.m_spans = {} # span name -> [calls, total seconds, longest seconds]
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.m_lock:
+                totals = self.m_spans.get(name)
+                if totals is None:
+                    totals = self.m_spans[name] = [0, 0.0, 0.0]
+                totals[0] += 1
+                totals[1] += elapsed
+                totals[2] = max(totals[2], elapsed)
+            self.m_metrics.observe("vaccinechecker_span_duration_seconds", { "span" : name }, elapsed)
+
+    '''
+    The spans of the cycle that just ended as (name, calls, total, longest), most time
+    first.
+    '''
+    def end_cycle(self):
+        with self.m_lock:
+            spans = self.m_spans
+            self.m_spans = {}
+        return sorted(((name, t[0], t[1], t[2]) for name, t in spans.items()), key=lambda span: -span[2])
+
+'''
+A sampling profiler covering every thread (cProfile only sees the thread it runs on,
+and sites are queried on the executor's).  Between start() and stop() a background
+thread records the stack of each other thread every INTERVAL seconds.  stop() returns
+the samples as collapsed stacks, one 'outermost;...;innermost count' line per distinct
+stack, which flame graph tools (i.e. flamegraph.pl, speedscope) read.
+'''
+class StackSampler(object):
+
+    INTERVAL = 0.005 # seconds between samples
+
+    def __init__(self):
+        self.m_counts = collections.Counter() # collapsed stack -> samples
+        self.m_stop = threading.Event()
+        self.m_thread = None
+
+    def start(self):
+        self.m_thread = threading.Thread(target=self.loop, name="sampler")
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def loop(self):
+        me = threading.get_ident()
+        while not self.m_stop.wait(self.INTERVAL):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%d" % (ident)))
+                self.m_counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.m_stop.set()
+        self.m_thread.join()
+        return "".join("%s %d\n" % (stack, count) for stack, count in sorted(self.m_counts.items()))
+
+'''
+Pushes status changes to browsers as Server-Sent Events on GET /events, so pages
+don't have to poll.  A client first gets a 'snapshot' event (the status of every
+site), then a 'transition' event for every status change.  A client reconnecting
+with 'Last-Event-ID' (header, or 'lastEventId' in the query string) only gets the
+events it missed, if they are still among the last BACKLOG.
+
+All connections are served by one asyncio event loop on its own thread, so thousands
+of idle clients cost a socket and a few KB each.  publish() and set_snapshot() may be
+called from any thread.
+'''
+class PushServer(object):
+
+    KEEPALIVE = 15 # seconds between comments sent to every client, so proxies keep them open
+    BACKLOG = 1000 # events kept for reconnecting clients
+    MAX_BUFFERED = 256 * 1024 # bytes waiting to be sent to a client before it is dropped as too slow
+    REQUEST_TIMEOUT = 10 # seconds for a client to send its request
+
+    def __init__(self, address, log):
+        self.m_address = address
+        self.m_log = log
+        self.m_clients = set() # asyncio.StreamWriter of each connected client
+        self.m_events = collections.deque(maxlen=self.BACKLOG) # (id, encoded event)
+        self.m_sequence = 0 # id of the last event
+        self.m_snapshot = (0, "{}") # (id of the last event it includes, JSON)
+        import asyncio
+        self.m_loop = asyncio.new_event_loop()
+
+    def start(self):
+        # every client is a file descriptor
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+        import asyncio
+        server = self.m_loop.run_until_complete(asyncio.start_server(self.handle, self.m_address[0], self.m_address[1], backlog=1024))
+        self.m_loop.create_task(self.keepalive())
+        thread = threading.Thread(target=self.m_loop.run_forever, name="push")
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def publish(self, kind, data):
+        self.m_loop.call_soon_threadsafe(self.broadcast, kind, json.dumps(data, separators=(",", ":")))
+
+    def set_snapshot(self, data):
+        self.m_loop.call_soon_threadsafe(self.store_snapshot, json.dumps(data, separators=(",", ":"), sort_keys=True))
+
+    # the rest runs on the event loop's thread
+
+    def store_snapshot(self, data):
+        self.m_snapshot = (self.m_sequence, data)
+
+    def event(self, sequence, kind, data):
+        return ("id: %d\nevent: %s\ndata: %s\n\n" % (sequence, kind, data)).encode("utf-8")
+
+    def broadcast(self, kind, data):
+        self.m_sequence += 1
+        message = self.event(self.m_sequence, kind, data)
+        self.m_events.append((self.m_sequence, message))
+        for writer in list(self.m_clients):
+            self.send(writer, message)
+
+    def send(self, writer, message):
+        if writer.transport.is_closing() or writer.transport.get_write_buffer_size() > self.MAX_BUFFERED:
+            self.m_clients.discard(writer)
+            writer.close()
+            return
+        writer.write(message)
+
+    '''
+    Send a new client what it missed: only the events after 'lastId' if they are all
+    still kept, otherwise the snapshot and the events since it was taken.
+    '''
+    def catch_up(self, writer, lastId):
+        try:
+            sequence = int(lastId)
+        except (TypeError, ValueError):
+            sequence = None
+        oldest = self.m_events[0][0] if self.m_events else self.m_sequence + 1
+        if sequence is None or sequence > self.m_sequence or sequence < oldest - 1:
+            sequence, data = self.m_snapshot
+            writer.write(self.event(sequence, "snapshot", data))
+        for eventSequence, message in self.m_events:
+            if eventSequence > sequence:
+                writer.write(message)
+
+    async def handle(self, reader, writer):
+        import asyncio
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        lines = request.decode("latin-1").split("\r\n")
+        parts = lines[0].split()
+        url = urlsplit(parts[1] if len(parts) > 1 else "")
+        if not parts or "GET" != parts[0] or "/events" != url.path:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        headers = dict((k.strip().lower(), v.strip()) for k, sep, v in (line.partition(":") for line in lines[1:]) if sep)
+        query = dict(p.partition("=")[::2] for p in url.query.split("&") if p)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\n\r\n")
+        self.catch_up(writer, headers.get("last-event-id", query.get("lastEventId")))
+        self.m_clients.add(writer)
+        try:
+            # clients don't send anything more; this returns when they go away
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.m_clients.discard(writer)
+            writer.close()
+
+    async def keepalive(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(self.KEEPALIVE)
+            for writer in list(self.m_clients):
+                self.send(writer, b":\n\n")
+
+'''
+Raised instead of querying a host whose circuit breaker is open.  'retryAt' is when the
+circuit lets a trial request through, or 0 if one is already under way.
+'''
+class CircuitOpenError(Exception):
+
+    def __init__(self, message, retryAt):
+        Exception.__init__(self, message)
+        self.m_retryAt = retryAt
+
+'''
+Raised when a page is larger, or takes longer to download, than its site allows.
+'''
+class ResponseLimitError(Exception):
+    pass
+
+'''
+Circuit breaker for one provider host.  After FAILURE_THRESHOLD failures in a row the
+circuit opens and requests to the host fail immediately (without waiting out TIMEOUT)
+for a while; then a single trial request is let through (half open).  If it succeeds
+the circuit closes, otherwise it opens again for twice as long, up to MAX_OPEN.
+'''
+class CircuitBreaker(object):
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    FAILURE_THRESHOLD = 3
+    OPEN_TIME = 60 # seconds
+    MAX_OPEN = 30 * 60 # seconds
+
+    def __init__(self, host):
+        self.m_host = host
+        self.m_lock = threading.Lock()
+        self.m_state = self.CLOSED
+        self.m_failures = 0 # in a row
+        self.m_openTime = self.OPEN_TIME
+        self.m_openUntil = 0
+
+    def state(self):
+        with self.m_lock:
+            return self.m_state
+
+    '''
+    Call before each request.  Raises CircuitOpenError if the host shouldn't be asked.
+    '''
+    def before(self):
+        with self.m_lock:
+            if self.CLOSED == self.m_state:
+                return
+            if self.OPEN == self.m_state and time.time() >= self.m_openUntil:
+                self.m_state = self.HALF_OPEN # this caller makes the trial request
+                return
+            raise CircuitOpenError("circuit for '%s' is %s" % (self.m_host, self.m_state), self.m_openUntil if self.OPEN == self.m_state else 0)
+
+    def success(self):
+        with self.m_lock:
+            self.m_state = self.CLOSED
+            self.m_failures = 0
+            self.m_openTime = self.OPEN_TIME
+
+    '''
+    Record a failure.  Returns True if this opened the circuit.
+    '''
+    def failure(self):
+        with self.m_lock:
+            self.m_failures += 1
+            if self.HALF_OPEN == self.m_state:
+                self.m_openTime = min(self.m_openTime * 2, self.MAX_OPEN)
+            elif self.m_failures < self.FAILURE_THRESHOLD or self.OPEN == self.m_state:
+                return False
+            self.m_state = self.OPEN
+            self.m_openUntil = time.time() + self.m_openTime
+            return True
+
+'''
+Token bucket limiting how fast one host is sent requests: 'rate' requests per second
+on average, with bursts of up to 'burst'.  take() blocks until a request may be made.
+'''
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.m_rate = rate
+        self.m_burst = burst
+        self.m_tokens = burst
+        self.m_last = time.time()
+        self.m_lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.m_lock:
+                now = time.time()
+                self.m_tokens = min(self.m_burst, self.m_tokens + (now - self.m_last) * self.m_rate)
+                self.m_last = now
+                if self.m_tokens >= 1:
+                    self.m_tokens -= 1
+                    return
+                wait = (1 - self.m_tokens) / self.m_rate
+            time.sleep(wait)
+
+'''
+Consistent hashing of site names onto workers.  Each worker gets VNODES points on
+the ring and a site goes to the worker owning the first point at or after its hash,
+so adding or removing a worker only moves the sites that worker gains or loses.
+'''
+class HashRing(object):
+
+    VNODES = 64
+
+    def __init__(self, nodes):
+        self.m_ring = sorted((self.hash("%s#%d" % (node, i)), node) for node in nodes for i in range(self.VNODES))
+        self.m_points = [point for point, node in self.m_ring]
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+    '''
+    Returns the node 'key' belongs to, or None if there are no nodes.
+    '''
+    def node_for(self, key):
+        if not self.m_ring:
+            return None
+        i = bisect.bisect_left(self.m_points, self.hash(key)) % len(self.m_ring)
+        return self.m_ring[i][1]
+
+'''
+The cities of a coordinates table (a 'state,city,latitude,longitude' CSV file, i.e.
+'input/cities.csv') bucketed on a grid of CELL degree squares, so the cities within a
+radius are found by looking in the few cells the radius covers, not at every city.
+'''
+class CityIndex(object):
+
+    CELL = 0.5 # degrees of latitude / longitude per grid cell, about 35 miles north to south
+    EARTH_RADIUS = 3958.8 # miles
+    MILES_PER_DEGREE = 69.0 # of latitude
+
+    def __init__(self, filename):
+        self.m_cells = {} # (row, column) -> [(STATE, CITY, latitude, longitude)]
+        self.m_cities = {} # (STATE, CITY) -> (latitude, longitude)
+        f = open(filename, newline="")
+        for row in csv.DictReader(f):
+            state = row["state"].strip().upper()
+            city = row["city"].strip().upper()
+            latitude = float(row["latitude"])
+            longitude = float(row["longitude"])
+            self.m_cities[(state, city)] = (latitude, longitude)
+            self.m_cells.setdefault(self.cell(latitude, longitude), []).append((state, city, latitude, longitude))
+        f.close()
+
+    def cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.CELL)), int(math.floor(longitude / self.CELL)))
+
+    '''
+    (latitude, longitude) of 'city' in 'state', or None if it isn't in the table.
+    '''
+    def locate(self, state, city):
+        return self.m_cities.get((state.upper(), city.upper()))
+
+    '''
+    Great circle distance in miles.
+    '''
+    def distance(self, latitude1, longitude1, latitude2, longitude2):
+        p1 = math.radians(latitude1)
+        p2 = math.radians(latitude2)
+        a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+        return 2 * self.EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+    '''
+    The cities within 'miles' of (latitude, longitude), as (miles, STATE, CITY), nearest
+    first.
+    '''
+    def near(self, latitude, longitude, miles):
+        latitudeSpan = miles / self.MILES_PER_DEGREE
+        longitudeSpan = miles / (self.MILES_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        top, left = self.cell(latitude - latitudeSpan, longitude - longitudeSpan)
+        bottom, right = self.cell(latitude + latitudeSpan, longitude + longitudeSpan)
+
+        found = []
+        for row in range(top, bottom + 1):
+            for column in range(left, right + 1):
+                for state, city, cityLatitude, cityLongitude in self.m_cells.get((row, column), ()):
+                    d = self.distance(latitude, longitude, cityLatitude, cityLongitude)
+                    if d <= miles:
+                        found.append((d, state, city))
+        found.sort()
+        return found
+
+'''
+Site types are provider plugins: a class registered in PROVIDERS under the 'type' it
+handles.  Querying a site goes through three stages:
+
+* prepare(name, site): once, when the site is read from 'websites.json'
+* fetch(name, site): get the site's document (i.e. a page, an answer from a form), or,
+  if batch_key(name, site) isn't None, fetch_batch(key): one fetch per key per polling
+  period (see FeedCache), shared by every site with that key (i.e. a CVS state feed)
+* parse(name, site, document): turn the document into (Availability, html)
+
+fetch() and parse() run on the worker threads, so they must not touch status.  One
+instance of each provider serves all its sites.
+'''
+class Provider(object):
+
+    REQUIRED_FIELDS = () # fields every site of this type must have in 'websites.json'
+
+    def __init__(self, checker):
+        self.m_checker = checker
+
+    def prepare(self, name, site):
+        pass
+
+    '''
+    'name' was removed from 'websites.json' (or is about to be prepared again).
+    '''
+    def forget(self, name):
+        pass
+
+    def batch_key(self, name, site):
+        return None
+
+    def fetch(self, name, site):
+        raise NotImplementedError()
+
+    def fetch_batch(self, key):
+        raise NotImplementedError()
+
+    def parse(self, name, site, document):
+        raise NotImplementedError()
+
+    '''
+    Release whatever the provider holds on to (i.e. browsers) when the program exits.
+    '''
+    def close(self):
+        pass
+
+'''
+Looks for the presence or absence of 'pos_phrase' / 'neg_phrase' in a page.  The page
+is streamed through the site's PhraseMatcher as it downloads, as bytes in its own
+charset, and cut off at 'max_bytes' / 'max_time'.
+'''
+class PhraseProvider(Provider):
+
+    REQUIRED_FIELDS = ("website",)
+
+    def __init__(self, checker):
+        Provider.__init__(self, checker)
+        self.m_matchers = {} # site name -> PhraseMatcher
+
+    '''
+    'pos_phrase' / 'neg_phrase' can be a single phrase or a list of phrases.
+    '''
+    def phrase_list(self, value):
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    def prepare(self, name, site):
+        self.m_matchers[name] = PhraseMatcher(self.phrase_list(site.get('pos_phrase', [])), self.phrase_list(site.get('neg_phrase', [])))
+
+    def forget(self, name):
+        self.m_matchers.pop(name, None)
+
+    '''
+    Returns (streaming response, status of the last full response).
+    '''
+    def fetch(self, name, site):
+        self.m_checker.DEBUG("INFO: asking %s at %s ..." % (name, site['website']))
+        return self.m_checker.http_get(site['website'], name, verify=False, stream=True)
+
+    def parse(self, name, site, document):
+        checker = self.m_checker
+        r, previous = document
+        try:
+            if 304 == r.status_code:
+                checker.DEBUG("INFO: %s not modified since last request" % (name))
+                return previous, ""
+
+            # a read waits for a whole chunk, so a page trickling in a byte at a time is cut
+            # off by a timer at 'max_time' rather than between chunks
+            maxTime = site.get('max_time', checker.MAX_RESPONSE_TIME)
+            deadline = time.time() + maxTime
+            timer = threading.Timer(maxTime, self.cut_off, (r,))
+            timer.daemon = True
+            timer.start()
+            try:
+                # the page is only kept in memory if it may need to be archived
+                chunks = self.limited(name, site, r.iter_content(chunk_size=checker.CHUNK_SIZE), deadline)
+                status, html = self.m_matchers[name].scan(chunks, checker.m_enableArchive, r.encoding or "utf-8")
+            except OSError:
+                if time.time() < deadline:
+                    raise
+                raise ResponseLimitError("'%s' took longer than %d seconds to send its page" % (name, maxTime))
+            finally:
+                timer.cancel()
+        finally:
+            checker.release_response(r)
+            checker.m_metrics.inc("vaccinechecker_response_bytes_total", { "source" : name }, r.raw.tell())
+
+        checker.remember_response(name, r, status)
+        return status, html
+
+    '''
+    Pass 'chunks' through, raising ResponseLimitError once more than the site's
+    'max_bytes' were read or 'deadline' has gone by.
+    '''
+    def limited(self, name, site, chunks, deadline):
+        maxBytes = site.get('max_bytes', self.m_checker.MAX_RESPONSE_BYTES)
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            if total > maxBytes:
+                raise ResponseLimitError("'%s' sent more than %d bytes" % (name, maxBytes))
+            if time.time() > deadline:
+                raise ResponseLimitError("'%s' took longer than %d seconds to send its page" % (name, site.get('max_time', self.m_checker.MAX_RESPONSE_TIME)))
+            yield chunk
+
+    '''
+    Shut down the connection under the streaming response 'r', so a read blocked on it
+    returns (with an error) at once.  Closing the response doesn't wake the read.
+    '''
+    def cut_off(self, r):
+        sock = getattr(getattr(r.raw, "_connection", None), "sock", None)
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+'''
+Looks up 'city' in the CVS feed of 'state'.  Sites in the same state share one fetch.
+'''
+class CvsProvider(Provider):
+
+    REQUIRED_FIELDS = ("state", "city")
+
+    def __init__(self, checker):
+        Provider.__init__(self, checker)
+        self.m_nearby = {} # site name -> [(miles, STATE, CITY)] within its 'radius', nearest first
+
+    '''
+    A site with a 'radius' is any CVS within that many miles of 'city', 'state'.  The
+    cities (and so the state feeds) it covers are looked up once here.
+    '''
+    def prepare(self, name, site):
+        if "radius" not in site:
+            return
+        # load_websites() has checked the city is in the table
+        cityIndex = self.m_checker.city_index()
+        where = cityIndex.locate(site['state'], site['city'])
+        self.m_nearby[name] = cityIndex.near(where[0], where[1], site['radius'])
+        self.m_checker.DEBUG("INFO: '%s' covers %d cities in %s" % (name, len(self.m_nearby[name]), ", ".join(sorted(set(state for miles, state, city in self.m_nearby[name])))))
+
+    def forget(self, name):
+        self.m_nearby.pop(name, None)
+
+    def batch_key(self, name, site):
+        if name in self.m_nearby:
+            return None
+        return self.m_checker.CVS_URL.format(site['state'].lower())
+
+    '''
+    A 'radius' site spans every state it has cities in.  Each state feed is still fetched
+    once per polling period, shared with every other site in that state.
+    '''
+    def fetch(self, name, site):
+        mappings = {}
+        for state in sorted(set(state for miles, state, city in self.m_nearby[name])):
+            mappings.update(self.m_checker.m_feedCache.get(self.m_checker.CVS_URL.format(state.lower()), self.fetch_batch, self.m_checker.feed_max_age(name)))
+        return mappings
+
+    '''
+    Fetch a CVS state feed and index it by city.  Returns a dict of state -> city ->
+    status for every state in the feed.
+    '''
+    def fetch_batch(self, url):
+        checker = self.m_checker
+
+        checker.DEBUG("INFO: Requesting information from CVS...")
+        response, previous = checker.http_get(url, url, headers={"Referer":"https://www.cvs.com/immunizations/covid-19-vaccine"})
+        if 304 == response.status_code:
+            checker.DEBUG("INFO: CVS feed not modified, reusing last response")
+            return previous
+        payload = response.json()
+
+        checker.DEBUG("INFO: Received response, parsing information from CVS...")
+        mappings = {}
+        for state, items in payload["responsePayloadData"]["data"].items():
+            cities = {}
+            for item in items:
+                cities[item.get('city')] = item.get('status')
+            mappings[state] = cities
+
+        checker.remember_response(url, response, mappings)
+        return mappings
+
+    def parse(self, name, site, mappings):
+        if name in self.m_nearby:
+            for miles, state, city in self.m_nearby[name]:
+                response = mappings.get(state, {}).get(city)
+                if response is not None and "Fully Booked" != response:
+                    self.m_checker.DEBUG("INFO: Found availability in '%s, %s', %.0f miles away" % (city, state, miles))
+                    return Availability.MAYBE, ""
+            return Availability.PROBABLY_NOT, ""
+
+        state = site['state']
+        city = site['city']
+        try:
+            response = mappings[state][city.upper()]
+
+            if ("Fully Booked" == response):
+                self.m_checker.DEBUG("INFO: Found 'fully booked'")
+                return Availability.PROBABLY_NOT, ""
+            else:
+                return Availability.MAYBE, ""
+
+        except KeyError as e:
+            self.m_checker.DEBUG("WARNING: Could not find state '%s' or city '%s' in CVS response" % (state, city))
+            return Availability.PROBABLY_NOT, ""
+
+'''
+Looks up 'city' in the HEB locations feed.  All HEB sites share one fetch.
+'''
+class HebProvider(Provider):
+
+    REQUIRED_FIELDS = ("city",)
+
+    def batch_key(self, name, site):
+        return self.m_checker.HEB_URL
+
+    '''
+    Fetch the HEB locations feed and index it by city.  Returns a dict of
+    upper case city -> list of locations with open timeslots.
+    '''
+    def fetch_batch(self, url):
+        checker = self.m_checker
+
+        checker.DEBUG("INFO: Requesting information from HEB...")
+        response, previous = checker.http_get(url, url)
+        if 304 == response.status_code:
+            checker.DEBUG("INFO: HEB feed not modified, reusing last response")
+            return previous
+        d = response.json()
+
+        checker.DEBUG("INFO: Received response, parsing information from HEB...")
+        cities = {}
+        for location in d['locations']:
+            if location["openTimeslots"] != 0:
+                cities.setdefault(location["city"].upper(), []).append(location)
+
+        checker.remember_response(url, response, cities)
+        return cities
+
+    def parse(self, name, site, cities):
+        city = site['city'].upper()
+        locations = cities.get(city, [])
+        for location in locations:
+            self.m_checker.DEBUG("INFO: Found a match at HEB for '%s'! Zip code: '%s'. Open timeslots: %d" % (city, location['zip'], location['openTimeslots']))
+
+        if locations:
+            return Availability.MAYBE, ""
+        else:
+            return Availability.PROBABLY_NOT, ""
+
+'''
+Asks the Walgreens appointment form about 'query'.  Requires 'selenium' to be installed;
+the form is filled in by a pool of headless browsers, created when the first Walgreens
+site is prepared.
+'''
+class WalgreensProvider(Provider):
+
+    REQUIRED_FIELDS = ("query",)
+    HOST = "www.walgreens.com"
+    BROWSER_MAX_USES = 50 # queries a browser handles before it is replaced with a fresh one
+    BROWSER_WAIT = 30 # seconds to wait for an element to show up on a page
+
+    def __init__(self, checker):
+        Provider.__init__(self, checker)
+        self.m_browserPool = None
+
+    '''
+    Utility function for setting up selenium (needed for navigation on websites).
+    Returns a new headless browser.
+    '''
+    def selenium_setup(self):
+
+        from selenium import webdriver
+        options = webdriver.firefox.options.Options()
+        options.headless = True
+        self.m_checker.DEBUG("INFO: Creating selenium object...")
+
+        # assumes 'geckodriver' binary is in path
+        sd = webdriver.Firefox(options=options)
+        sd.set_page_load_timeout(30)
+        self.m_checker.DEBUG("INFO: Done setting up selenium.")
+        return sd
+
+    def prepare(self, name, site):
+        if self.m_browserPool is not None:
+            return
+        self.m_checker.DEBUG("INFO: Setting up Python package 'selenium' for queries requiring user navigation (i.e  Walgreens)...")
+        # browsers are only started when a Walgreens site is first queried
+        self.m_browserPool = BrowserPool(self.selenium_setup, self.m_checker.m_maxBrowsers, self.BROWSER_MAX_USES, self.m_checker.DEBUG)
+
+    '''
+    Returns the text of the result Walgreens shows for 'query'.
+    '''
+    def fetch(self, name, site):
+        checker = self.m_checker
+        checker.host_before(self.HOST)
+        try:
+            text = self.query_form(site['query'])
+        except Exception:
+            checker.host_after(self.HOST, False)
+            raise
+        checker.host_after(self.HOST, True)
+        return text
+
+    def query_form(self, q):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions
+
+        checker = self.m_checker
+        with self.m_browserPool.browser() as browser:
+            sd = browser.driver
+            wait = WebDriverWait(sd, self.BROWSER_WAIT)
+
+            # the landing page only has to be clicked through once per browser
+            if not browser.screened:
+                s = "https://www.walgreens.com/findcare/vaccination/covid-19"
+                checker.DEBUG("INFO: Requesting site '%s'" % (s))
+                sd.get(s)
+                btn = wait.until(expected_conditions.element_to_be_clickable((By.CSS_SELECTOR, 'span.btn.btn__blue')))
+                btn.click()
+                browser.screened = True
+
+            s = "https://www.walgreens.com/findcare/vaccination/covid-19/location-screening"
+            checker.DEBUG("INFO: Requesting site '%s'" % (s))
+            sd.get(s)
+            element = wait.until(expected_conditions.presence_of_element_located((By.ID, "inputLocation")))
+            element.clear()
+
+            checker.DEBUG("INFO: Asking Walgreens about the location '%s'" % (q))
+            element.send_keys(q)
+            button = wait.until(expected_conditions.element_to_be_clickable((By.CSS_SELECTOR, "button.btn")))
+            button.click()
+
+            # raises selenium's TimeoutException if no result shows up
+            checker.DEBUG("INFO: Waiting for Walgreens result...")
+            response = wait.until(lambda d: self.walgreens_result(d, By))
+            return response.text
+
+    '''
+    Wait condition for query_form(): the result paragraph, once it has text.
+    '''
+    def walgreens_result(self, sd, By):
+        for element in sd.find_elements(By.CSS_SELECTOR, "p.fs16"):
+            if element.text:
+                return element
+        return False
+
+    def parse(self, name, site, text):
+        self.m_checker.DEBUG("INFO: Found Walgreens result '%s'" % (text))
+        if "Appointments unavailable" == text:
+            return Availability.PROBABLY_NOT, ""
+        elif "Please enter a valid city and state or ZIP" == text:
+            return Availability.PROBABLY_NOT, ""
+        else:
+            return Availability.MAYBE, ""
+
+    def close(self):
+        if self.m_browserPool is not None:
+            self.m_browserPool.close()
+
+'''
+Site 'type' -> provider class, as "Class" for the built-in ones or "module:Class".
+Classes are only imported once a site of their type is read from 'websites.json'.
+More can be registered with --provider.
+'''
+PROVIDERS = {
+    "phrase" : "PhraseProvider",
+    "cvs" : "CvsProvider",
+    "heb" : "HebProvider",
+    "walgreens" : "WalgreensProvider",
+}
+
+'''
+Import the provider class registered as 'path' (see PROVIDERS).
+'''
+def load_provider(path):
+    module, sep, name = path.rpartition(":")
+    if not sep:
+        return globals()[name]
+    return getattr(importlib.import_module(module), name)
+
+'''
+Primary class. 
+'''
+class vaccineChecker(object):
+
+    ##############################################
+    # to be populated by read of credentials.json
+    EMAIL = ""
+    PASSWORD = ""
+    RECIPIENTS =  []
+    SMTP_HOST = ""
+    SMTP_PORT = 0
+    ##############################################
+
+    MIN_REQUEST_RATE = 5 # seconds
+    VARIANCE = 10 # seconds of jitter added to every request interval
+    DEFAULT_MAX_CONCURRENCY = 10 # number of sites queried at the same time
+    DEFAULT_MAX_BROWSERS = 2 # number of selenium browsers kept for sites that need navigation
+    DEFAULT_HOST_RATE = 5 # requests per second to any one provider host
+    HOST_BURST = 10 # requests a host can be sent at once before DEFAULT_HOST_RATE applies
+    MAX_ATTEMPTS = 0 # maximum runs of main while loop. 0 = run forever.
+    TIMEOUT = 10 # website access timeout (seconds)
+
+    m_attempts = 0 # total runs of main while loop
+
+    # command line arguments
+    m_websitesFile = "" # location of 'websites.json'
+    m_outputDir = "" # the directory were status.json gets written to
+    m_credentialsFile = "" # location of 'credentials.json'
+    m_notificationRate = 0 # how often, in minutes, we should send a emailed notification with script status
+    m_notificationWindow = 0 # seconds to gather notifications into a single email
+    m_notifier = None # Notifier that sends emails in the background, if m_notificationRate
+    m_nextHeartbeat = 0 # when the next heartbeat email is due. 0 = never
+    m_enableArchive = False # whether or not files should be written as archives in m_outputDir
+    m_archiveRetention = 0 # how many days archives are kept. 0 = forever.
+    m_archive = None # ArchiveStore in m_outputDir, if m_enableArchive
+    HISTORY_FILENAME = "history.sqlite"
+    m_history = None # HistoryStore in m_outputDir, if enabled
+    m_latencies = {} # site name -> seconds its last query took
+    m_requestRate = 0 # how often, in seconds, we should ask for website status
+    m_verbose = False # if set to true, prints out function name and process ID when logging
+    m_maxConcurrency = DEFAULT_MAX_CONCURRENCY # how many sites are queried in parallel each cycle
+
+    # initially populated with 'websites.json', but then updated continuously
+    m_websites = {}
+
+    # selenium browsers for accessing sites that require special navigation (i.e. WalgreensProvider)
+    m_maxBrowsers = DEFAULT_MAX_BROWSERS
+
+    # CVS and HEB feeds shared between sites, refreshed once per polling period
+    m_feedCache = None
+    CVS_URL = "https://www.cvs.com/immunizations/covid-19-vaccine.vaccine-status.{}.json?vaccineinfo"
+    HEB_URL = "http://heb-ecom-covid-vaccine.hebdigital-prd.com/vaccine_locations.json"
+
+    # city coordinates for CVS sites with a 'radius'
+    CITIES_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input", "cities.csv")
+    m_citiesFile = CITIES_FILENAME
+    m_cityIndex = None # CityIndex of m_citiesFile, loaded for the first site with a 'radius'
+
+    # keep-alive HTTP sessions, one per host, and the 'ETag' / 'Last-Modified' of the
+    # last response for each site or feed so unchanged pages aren't downloaded again
+    m_sessions = {} # host -> requests.Session
+    m_validators = {} # site name or feed URL -> (etag, last modified, result of last parse)
+    m_httpLock = None # protects m_sessions and m_validators
+
+    # per provider host circuit breakers and rate limits
+    m_hostRate = DEFAULT_HOST_RATE
+    m_circuitBreakers = True # False: every request goes out, however the host is doing
+    m_hosts = {} # host -> (CircuitBreaker or None, TokenBucket or None)
+
+    # site types, resolved when 'websites.json' is read
+    m_providerPaths = {} # type -> provider class path, PROVIDERS plus --provider
+    m_providers = {} # type -> Provider, created for the first site of the type
+    m_siteProviders = {} # site name -> Provider
+
+    # when each site is polled next
+    m_scheduler = None
+
+    # --supervise: the polling worker runs in a child process that is started again if it
+    # dies.  Every CHECKPOINT_INTERVAL seconds it saves what a restarted worker needs to
+    # pick up where it left off (site status, scheduling state, validators and the last
+    # results of conditional requests) to CHECKPOINT_FILENAME in the output directory.
+    m_supervised = False
+    m_restarted = False # this worker replaces one that died; restore the checkpoint
+    CHECKPOINT_FILENAME = "checkpoint.json.gz"
+    CHECKPOINT_INTERVAL = 10 # seconds
+    m_lastCheckpoint = 0
+    m_checkpointHash = None # hash of the last checkpoint written, to skip unchanged writes
+    m_restoredSchedules = {} # site name -> SiteScheduler.snapshot() from the checkpoint
+
+    # 'websites.json' is re-read when it changes or on SIGHUP
+    RELOAD_CHECK_INTERVAL = 5 # seconds between checks of its modification time
+    m_websitesMtime = 0
+    m_reloadRequested = False
+
+    # fields of a site in 'websites.json' that this program fills in, as opposed to settings
+    RUNTIME_FIELDS = ("status", "update_time", "stale")
+
+    # output written for 'index.php'
+    STATUS_JSON_FILENAME = "status.json"
+    STATUS_DELTA_FILENAME = "status.delta.jsonl" # one line per status transition, appended
+
+    # rendered along with 'status.json' so the web tier can serve static files: the
+    # site buttons of 'index.php' and the fields its page refreshes from, each with a
+    # '.gz' (and '.br', if the 'brotli' package is installed) pre-compressed copy
+    STATUS_HTML_FILENAME = "status.fragment.html"
+    STATUS_MIN_JSON_FILENAME = "status.min.json"
+    STATUS_COLORS = { "probably" : "#82CA9D", "maybe" : "#FFF79A", "probably not" : "#F7977A" }
+    HIDDEN_SITES = ("Test Site",) # shown by 'index.php' only with '?debug_test'
+    m_statusHash = None # hash of the last 'status.json' written, to skip unchanged writes
+    m_transitions = [] # status transitions not yet appended to STATUS_DELTA_FILENAME
+
+    # instrumentation, served on 127.0.0.1:m_metricsPort and/or written to m_metricsFile
+    m_metrics = None
+    m_metricsPort = 0 # 0 = not served
+    m_metricsFile = "" # for the node exporter's textfile collector. "" = not written
+
+    # status changes pushed to browsers as Server-Sent Events on 127.0.0.1:m_pushPort/events
+    m_pushPort = 0 # 0 = not served
+    m_pushServer = None
+
+    # --profile: timing spans around each cycle and the work in it, logged per cycle, and
+    # every m_profileEvery cycles the stacks of every thread sampled into
+    # 'profile.[cycle].folded' next to 'status.json'
+    m_profiler = None # Profiler, or None when not profiling
+    m_profileEvery = 0 # 0 = no stack samples
+    m_profileCycle = 0
+    PROFILE_KEEP = 10 # newest stack sample files kept
+    NO_SPAN = contextlib.nullcontext()
+    CHUNK_SIZE = 64 * 1024 # bytes read at a time from 'phrase' sites
+    DRAIN_BYTES = 64 * 1024 # most bytes left unread of a page that are read off to keep its connection
+    MAX_RESPONSE_BYTES = 10 * 1024 * 1024 # most bytes read of a 'phrase' page, unless the site sets 'max_bytes'
+    MAX_RESPONSE_TIME = 60 # most seconds spent reading a 'phrase' page, unless the site sets 'max_time'
+
+    # sharding across processes / hosts through a shared directory:
+    #   <shard dir>/workers/<id>.json  heartbeat of each worker
+    #   <shard dir>/assignment.json    worker id -> site names, written by the coordinator
+    #   <shard dir>/results/<id>.json  latest result of each site a worker polls
+    ROLES = ("standalone", "coordinator", "worker")
+    m_role = "standalone"
+    m_shardDir = ""
+    m_workerId = ""
+    WORKER_TIMEOUT = 30 # seconds without a heartbeat before a worker's sites move to the others
+    COORDINATOR_INTERVAL = 2 # seconds between merges of the workers' results
+    m_assigned = set() # worker: names of the sites in this worker's shard
+    m_assignmentTime = 0 # worker: the 'time' the coordinator wrote into the last 'assignment.json' read
+    m_assignment = None # coordinator: last assignment written
+    m_resultTimes = {} # site name -> time of its last result, as polled (worker) or merged (coordinator)
+    m_resultOwners = {} # coordinator: site name -> worker the last merged result came from
+
+    '''
+    Setup.
+    '''
+    def __init__(self, websitesFile, outputDir, credentialsFile, notificationRate, enableArchive, requestRate, verbose, maxConcurrency=DEFAULT_MAX_CONCURRENCY, maxBrowsers=DEFAULT_MAX_BROWSERS, archiveRetention=0, notificationWindow=0, logLevel="INFO", logFormat="text", metricsPort=0, metricsFile="", maxAttempts=None, cvsUrl=None, hebUrl=None, hostRate=DEFAULT_HOST_RATE, role="standalone", shardDir="", workerId="", enableHistory=False, pushPort=0, providers=None, citiesFile=None, profile=False, profileEvery=0, supervised=False, restarted=False, circuitBreakers=True):
+
+        self.m_verbose = verbose
+        setup_logging(verbose, logLevel, logFormat)
+        self.DEBUG("INFO: Initializing....")
+
+        self.m_websitesFile = websitesFile
+        self.m_outputDir = outputDir
+        self.m_credentialsFile = credentialsFile
+        self.m_notificationRate = notificationRate
+        self.m_notificationWindow = notificationWindow
+        self.m_enableArchive = enableArchive
+        self.m_archiveRetention = archiveRetention
+        self.m_requestRate = requestRate
+        self.m_maxConcurrency = max(1, maxConcurrency)
+        self.m_maxBrowsers = max(1, maxBrowsers)
+        self.m_feedCache = FeedCache()
+        self.m_sessions = {}
+        self.m_validators = {}
+        self.m_httpLock = threading.Lock()
+        self.m_hostRate = hostRate
+        self.m_circuitBreakers = circuitBreakers
+        self.m_hosts = {}
+        self.m_transitions = []
+        self.m_metrics = Metrics()
+        self.m_metricsPort = metricsPort
+        self.m_metricsFile = metricsFile
+        if maxAttempts is not None:
+            self.MAX_ATTEMPTS = maxAttempts
+        if cvsUrl is not None:
+            self.CVS_URL = cvsUrl
+        if hebUrl is not None:
+            self.HEB_URL = hebUrl
+        if citiesFile is not None:
+            self.m_citiesFile = citiesFile
+        self.m_role = role
+        self.m_shardDir = shardDir
+        self.m_workerId = workerId if "" != workerId else "%s-%d" % (socket.gethostname(), os.getpid())
+        self.m_assigned = set()
+        self.m_resultTimes = {}
+        self.m_resultOwners = {}
+        self.m_latencies = {}
+        self.m_pushPort = pushPort
+        if profile:
+            self.m_profiler = Profiler(self.m_metrics)
+        self.m_profileEvery = profileEvery
+        self.m_supervised = supervised
+        self.m_restarted = restarted
+        self.m_restoredSchedules = {}
+        self.m_providerPaths = dict(PROVIDERS)
+        self.m_providerPaths.update(providers or {})
+        self.m_providers = {}
+        self.m_siteProviders = {}
+
+        if 0 != self.m_metricsPort:
+            server = MetricsServer(("127.0.0.1", self.m_metricsPort), self.m_metrics)
+            thread = threading.Thread(target=server.serve_forever, name="metrics")
+            thread.daemon = True
+            thread.start()
+            self.DEBUG("INFO: Serving metrics on http://127.0.0.1:%d/metrics" % (self.m_metricsPort))
+
+        if 0 != self.m_pushPort:
+            self.m_pushServer = PushServer(("127.0.0.1", self.m_pushPort), self.DEBUG)
+            self.m_pushServer.start()
+            self.DEBUG("INFO: Pushing status changes on http://127.0.0.1:%d/events" % (self.m_pushPort))
+
+        if self.m_enableArchive:
+            self.m_archive = ArchiveStore(self.m_outputDir + "/archive", self.m_archiveRetention, self.DEBUG)
+
+        if enableHistory:
+            if (not os.path.exists(self.m_outputDir)):
+                os.makedirs(self.m_outputDir)
+            self.m_history = HistoryStore(self.m_outputDir + "/" + self.HISTORY_FILENAME)
+            self.DEBUG("INFO: Recording poll history in '%s'" % (self.m_history.m_filename))
+
+        # if configured, for confirmation things are going ok, send a text/email
+        if (0 != self.m_notificationRate):
+            self.read_credentials()
+            self.m_notifier = Notifier(self.SMTP_HOST, self.SMTP_PORT, self.EMAIL, self.PASSWORD, [r.strip() for r in self.RECIPIENTS.split(',')], self.m_notificationWindow, os.path.basename(__file__), self.DEBUG)
+            self.DEBUG("INFO: --notification-rate passed, configuring to send heartbeat message every %d minutes" % (self.m_notificationRate))
+            self.heartbeat()
+            self.m_nextHeartbeat = time.time() + self.m_notificationRate * 60
+        else:
+            self.DEBUG("INFO: --notification-rate not passed, no notifications will be sent.")
+
+        self.read_websites()
+
+
+    '''
+    Utility function for logging.  Send to standard out and syslog, at the level given by
+    the message's prefix (i.e. "WARNING: ...").  Messages without one are logged as
+    WARNING (tracebacks as ERROR), so --log-level can't hide them by accident.  Messages
+    below the configured level cost next to nothing; the rest are formatted and written
+    on the logging thread.
+    '''
+    def DEBUG(self, x):
+        prefix = x[:x.find(":")]
+        level = LOG_LEVELS.get(prefix)
+        if level is None:
+            level = logging.ERROR if x.startswith("Traceback") else logging.WARNING
+        if not LOGGER.isEnabledFor(level):
+            return
+
+        caller = sys._getframe(1)
+        code = caller.f_code
+        LOGGER.handle(LOGGER.makeRecord(LOGGER.name, level, code.co_filename, caller.f_lineno, x, None, None, code.co_name))
+   
+    '''
+    Read in credentials.json.
+    '''
+    def read_credentials(self):
+
+        filename = self.m_credentialsFile
+        example = ''' 
+{
+"email" : "foo@gmail.com",
+"password" : "bar",
+"recipients" : "foobar@tmomail.net,myname@yahoo.com",
+"smtp_host" : "smtp.myserver.com",
+"smtp_port" : 465
+}
+        '''
+        if (not os.path.exists(filename)):
+            self.DEBUG("ERROR: " + filename + ' file not found, exiting. example file contents: ' + example)
+            sys.exit(-1)
+
+        try:
+            f = open(filename)
+            c = json.loads(f.read())
+            f.close()
+
+            self.EMAIL = c['email']
+            self.PASSWORD = c['password']
+            self.RECIPIENTS = c['recipients']
+            self.SMTP_HOST = c['smtp_host']
+            self.SMTP_PORT = c['smtp_port']
+            self.DEBUG("INFO: Successfully read credentials file.")
+        except Exception as e:
+            self.DEBUG("ERROR: Problem reading file " + filename + '. valid example content: ' + example)
+            self.DEBUG(traceback.format_exc())
+            sys.exit(-1)
+
+    '''
+    Read in websites.json.
+    '''
+    def read_websites(self):
+
+        filename = self.m_websitesFile
+        example = ''' 
+{
+    "name": "UT Health San Antonio",
+    "type" : "phrase",
+    "website": "https://schedule.utmedicinesa.com/Identity/Account/Register",
+    "neg_phrase": "are full",
+    "pos_phrase": "you confirm your understanding",
+}
+        '''
+        if (not os.path.exists(filename)):
+            self.DEBUG("ERROR: " + filename + ' file not found, exiting. example file contents: ' + example)
+            sys.exit(-1)
+
+        try:
+            self.m_websitesMtime = os.path.getmtime(filename)
+            self.m_websites = self.load_websites(filename)
+        except Exception as e:
+            self.DEBUG("ERROR: Problem reading file " + filename + '. valid example content: ' + example)
+            self.DEBUG(traceback.format_exc())
+            sys.exit(-1)
+
+        self.restore_status()
+        if self.m_restarted:
+            self.restore_checkpoint()
+        for name in self.m_websites:
+            self.prepare_site(name)
+
+    '''
+    A site as configured in 'websites.json', without the fields filled in at runtime.
+    '''
+    def settings(self, site):
+        return dict((k, v) for k, v in site.items() if k not in self.RUNTIME_FIELDS)
+
+    def settings_hash(self, site):
+        return hashlib.md5(json.dumps(self.settings(site), sort_keys=True).encode("utf-8")).hexdigest()
+
+    def checkpoint_filename(self):
+        if "worker" == self.m_role:
+            return os.path.join(self.m_outputDir, "checkpoint.%s.json.gz" % (self.m_workerId))
+        return os.path.join(self.m_outputDir, self.CHECKPOINT_FILENAME)
+
+    '''
+    Save the state of this worker to its checkpoint, unless it is unchanged since the
+    last one.  Sites are saved with a hash of their settings, so a site changed in
+    'websites.json' in the meantime starts over instead of reusing stale state.
+    '''
+    def write_checkpoint(self):
+        self.m_lastCheckpoint = time.time()
+
+        sites = {}
+        for name, site in self.m_websites.items():
+            saved = dict((field, site[field]) for field in self.RUNTIME_FIELDS)
+            saved["settings"] = self.settings_hash(site)
+            if self.m_scheduler is not None:
+                saved["schedule"] = self.m_scheduler.snapshot(name)
+            sites[name] = saved
+        validators = {}
+        with self.m_httpLock:
+            for key, (etag, lastModified, result) in self.m_validators.items():
+                validators[key] = [etag, lastModified, ["availability", result.value] if isinstance(result, Availability) else ["json", result]]
+
+        content = json.dumps({ "attempts" : self.m_attempts, "sites" : sites, "validators" : validators }, separators=(",", ":")).encode("utf-8")
+        checkpointHash = hashlib.sha256(content).hexdigest()
+        if checkpointHash == self.m_checkpointHash:
+            return
+        if (not os.path.exists(self.m_outputDir)):
+            os.makedirs(self.m_outputDir)
+        self.write_atomic(self.checkpoint_filename(), gzip.compress(content, 6))
+        self.m_checkpointHash = checkpointHash
+
+    '''
+    Pick up where the worker this one replaces left off, from its last checkpoint.  The
+    status of each site is only taken from it if 'status.json' wasn't written since;
+    scheduling state is applied once run() has created the scheduler.
+    '''
+    def restore_checkpoint(self):
+
+        filename = self.checkpoint_filename()
+        try:
+            f = gzip.open(filename, "rb")
+            checkpoint = json.loads(f.read().decode("utf-8"))
+            f.close()
+            checkpointTime = os.path.getmtime(filename)
+        except (OSError, EOFError, ValueError):
+            return
+        try:
+            statusTime = os.path.getmtime(self.m_outputDir + "/" + self.STATUS_JSON_FILENAME)
+        except OSError:
+            statusTime = 0
+
+        restored = set()
+        for name, saved in checkpoint.get("sites", {}).items():
+            site = self.m_websites.get(name)
+            if site is None or saved.get("settings") != self.settings_hash(site):
+                continue
+            if checkpointTime >= statusTime:
+                for field in self.RUNTIME_FIELDS:
+                    site[field] = saved[field]
+            if saved.get("schedule") is not None:
+                self.m_restoredSchedules[name] = saved["schedule"]
+            restored.add(name)
+
+        # validators are kept under the site name, or the URL of a shared feed
+        cached = 0
+        for key, (etag, lastModified, (kind, result)) in checkpoint.get("validators", {}).items():
+            if key in restored or (key not in self.m_websites and "://" in key):
+                self.m_validators[key] = (etag, lastModified, Availability(result) if "availability" == kind else result)
+                cached += 1
+
+        self.m_attempts = checkpoint.get("attempts", 0)
+        self.DEBUG("INFO: Restored %d sites and %d cached responses from '%s'" % (len(restored), cached, filename))
+
+    '''
+    Carry the status of each site over from the 'status.json' the last run wrote, so the
+    first sweep doesn't report every open site as a change.
+    '''
+    def restore_status(self):
+
+        filename = self.m_outputDir + "/" + self.STATUS_JSON_FILENAME
+        try:
+            f = open(filename)
+            previous = json.loads(f.read())
+            f.close()
+        except (OSError, ValueError):
+            return
+
+        restored = 0
+        for name, site in self.m_websites.items():
+            last = previous.get(name)
+            if isinstance(last, dict) and last.get('status') in [a.value for a in Availability]:
+                for field in self.RUNTIME_FIELDS:
+                    if field in last:
+                        site[field] = last[field]
+                restored += 1
+        self.DEBUG("INFO: Restored the status of %d sites from '%s'" % (restored, filename))
+
+    '''
+    Parse and validate a 'websites.json'.  Returns its sites, with the things the user
+    doesn't supply initialized.  Raises ValueError if the file isn't valid.
+    '''
+    def load_websites(self, filename):
+
+        f = open(filename)
+        websites = json.loads(f.read())
+        f.close()
+
+        if not isinstance(websites, dict):
+            raise ValueError("'websites.json' must be an object of site name -> site")
+
+        # initialize things the user doesn't supply
+        for name, site in websites.items():
+            if not isinstance(site, dict) or "type" not in site:
+                raise ValueError("Each site in 'websites.json' must have a 'type'.  See README.md")
+            providerClass = self.provider_class(site['type'])
+            for field in (providerClass.REQUIRED_FIELDS if providerClass is not None else ()):
+                if field not in site:
+                    raise ValueError("'%s' in 'websites.json' is missing '%s'" % (name, field))
+            if "interval" in site and (not isinstance(site["interval"], (int, float)) or site["interval"] < self.MIN_REQUEST_RATE):
+                raise ValueError("'interval' for '%s' in 'websites.json' must be a number of seconds, at least %d." % (name, self.MIN_REQUEST_RATE))
+            if "radius" in site and (not isinstance(site["radius"], (int, float)) or site["radius"] < 0):
+                raise ValueError("'radius' for '%s' in 'websites.json' must be a number of miles." % (name))
+            if "radius" in site and "cvs" == site['type'].lower() and self.city_index().locate(site['state'], site['city']) is None:
+                raise ValueError("'%s' in 'websites.json': '%s, %s' is not in '%s'" % (name, site['city'], site['state'], self.m_citiesFile))
+            for field in ("max_bytes", "max_time"):
+                if field in site and (not isinstance(site[field], (int, float)) or site[field] <= 0):
+                    raise ValueError("'%s' for '%s' in 'websites.json' must be a positive number." % (field, name))
+            if "status" not in site:
+                site["status"] =  Availability.PROBABLY_NOT.value
+            if "update_time" not in site:
+                site["update_time"] = ""
+            if "stale" not in site:
+                site["stale"] = False
+
+        return websites
+
+    '''
+    The city coordinates table, read from m_citiesFile the first time it's needed.
+    '''
+    def city_index(self):
+        if self.m_cityIndex is None:
+            self.m_cityIndex = CityIndex(self.m_citiesFile)
+        return self.m_cityIndex
+
+    '''
+    The provider class for the site type 'siteType', imported if it wasn't yet, or None
+    if no provider is registered for it.  Raises ValueError if it can't be imported.
+    '''
+    def provider_class(self, siteType):
+        path = self.m_providerPaths.get(siteType.lower())
+        if path is None:
+            return None
+        try:
+            return load_provider(path)
+        except (ImportError, AttributeError, KeyError) as e:
+            raise ValueError("Could not load provider '%s' for type '%s'. Error type %s : %s" % (path, siteType, type(e).__name__, str(e)))
+
+    '''
+    Set up whatever querying the site 'name' needs.
+    '''
+    def prepare_site(self, name):
+
+        # the coordinator never queries sites itself
+        if "coordinator" == self.m_role:
+            return
+
+        site = self.m_websites[name]
+        siteType = site['type'].lower()
+        provider = self.m_providers.get(siteType)
+        if provider is None:
+            providerClass = self.provider_class(siteType)
+            if providerClass is None:
+                self.DEBUG("WARNING: Type '%s' for website '%s' not found, it won't be queried" % (site['type'], name))
+                return
+            provider = self.m_providers[siteType] = providerClass(self)
+        provider.prepare(name, site)
+        self.m_siteProviders[name] = provider
+
+    '''
+    Ask for 'websites.json' to be re-read (i.e. on SIGHUP).  Safe to call from a signal
+    handler; the reload itself happens in the main loop within RELOAD_CHECK_INTERVAL.
+    '''
+    def request_reload(self):
+        self.m_reloadRequested = True
+
+    '''
+    If 'websites.json' changed on disk (or a reload was requested), read it again and
+    apply only the differences: removed sites are dropped, new sites are scheduled right
+    away, and sites whose settings changed are re-checked right away.  Unchanged sites
+    keep their status, 'update_time' and schedule.  If the new file isn't valid, the
+    current sites are kept.  Returns True if anything changed.
+    '''
+    def check_websites(self):
+
+        filename = self.m_websitesFile
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return False
+        if mtime == self.m_websitesMtime and not self.m_reloadRequested:
+            return False
+        self.m_websitesMtime = mtime
+        self.m_reloadRequested = False
+
+        try:
+            websites = self.load_websites(filename)
+        except Exception as e:
+            self.DEBUG("ERROR: Not reloading '%s', keeping the current sites. Error type %s : %s" % (filename, type(e).__name__, str(e)))
+            return False
+
+        removed = [name for name in self.m_websites if name not in websites]
+        added = [name for name in websites if name not in self.m_websites]
+        changed = [name for name in websites if name in self.m_websites and self.settings(websites[name]) != self.settings(self.m_websites[name])]
+
+        now = time.time()
+        for name in removed + changed:
+            self.m_scheduler.remove(name)
+            provider = self.m_siteProviders.pop(name, None)
+            if provider is not None:
+                provider.forget(name)
+            with self.m_httpLock:
+                self.m_validators.pop(name, None)
+        for name in removed:
+            del self.m_websites[name]
+        for name in changed:
+            for field in self.RUNTIME_FIELDS:
+                websites[name][field] = self.m_websites[name][field]
+        for name in changed + added:
+            self.m_websites[name] = websites[name]
+            try:
+                self.prepare_site(name)
+            except Exception as e:
+                self.DEBUG("ERROR: Could not set up '%s', leaving it out. Error type %s : %s" % (name, type(e).__name__, str(e)))
+                del self.m_websites[name]
+                continue
+            if self.is_mine(name):
+                self.m_scheduler.add(name, self.site_interval(name), now)
+
+        self.DEBUG("INFO: Reloaded '%s': %d added, %d removed, %d changed" % (filename, len(added), len(removed), len(changed)))
+        return bool(added or removed or changed)
+
+    '''
+    Given a string, logs it.  If notifications are enabled, it queues an email to RECIPIENTS,
+    using the credentials in EMAIL and PASSWORD, which is sent in the background.
+    '''
+    def send_message(self, s):
+
+        with self.span("send_message"):
+            self.DEBUG(s)
+
+            if (self.m_notificationRate == 0):
+                return
+
+            if (self.m_verbose):
+                caller = sys._getframe(1)
+                m = "[%s]\n[%s|%s|%s]\n%s\n%s\n" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), caller.f_code.co_name, caller.f_lineno, s, "http://sanantoniovaccine.com")
+            else:
+                m = "[%s]\n%s" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), s)
+
+            self.m_notifier.send(m)
+
+    '''
+    Utility function to let someone know the script is running a-ok.
+    '''
+    def heartbeat(self):
+        self.send_message("INFO: Heartbeat. m_attempts = '%d'." % (self.m_attempts))
+
+    '''
+    Send the heartbeat if it is due.
+    '''
+    def check_heartbeat(self):
+        now = time.time()
+        if self.m_nextHeartbeat and now >= self.m_nextHeartbeat:
+            self.heartbeat()
+            self.m_nextHeartbeat = now + self.m_notificationRate * 60
+
+    '''
+    Handle when a website status changes (i.e. from Availability.PROBABLY_NOT to Availability.MAYBE)
+    Returns True if the status changed.
+    '''
+    def handle_status(self, status, name, html):
+
+        site = self.m_websites[name]
+        if status.value != site['status']:
+            self.send_message("INFO: %s%s changed to %s" % (name, " (%s)" % (site['website']) if 'website' in site else "", status))
+            self.m_metrics.inc("vaccinechecker_status_transitions_total", { "site" : name, "status" : status.value })
+            transition = { "time" : datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), "name" : name, "from" : site['status'], "to" : status.value }
+            self.m_transitions.append(transition)
+            if self.m_pushServer is not None:
+                self.m_pushServer.publish("transition", transition)
+            if self.m_history is not None:
+                self.m_history.record_transition(name, time.time(), site['status'], status.value)
+
+            # save off HTML if passed 
+            if html and self.m_enableArchive:
+                blobHash = self.m_archive.put(name, "html", html)
+                self.DEBUG("INFO: Archiving HTML of '%s' as %s" % (name, blobHash))
+        else:
+            self.DEBUG("INFO: still %s for %s" % (status, name))
+
+        changed = status.value != site['status']
+        site['status'] = status.value
+        return changed
+
+    '''
+    Return the (CircuitBreaker, TokenBucket) of 'host'.
+    '''
+    def host_guard(self, host):
+        with self.m_httpLock:
+            guard = self.m_hosts.get(host)
+            if guard is None:
+                bucket = TokenBucket(self.m_hostRate, self.HOST_BURST) if self.m_hostRate else None
+                breaker = CircuitBreaker(host) if self.m_circuitBreakers else None
+                guard = self.m_hosts[host] = (breaker, bucket)
+            return guard
+
+    '''
+    Call before every request to 'host': fails fast with CircuitOpenError if the host's
+    circuit is open, otherwise waits for the host's rate limit.
+    '''
+    def host_before(self, host):
+        breaker, bucket = self.host_guard(host)
+        if breaker is not None:
+            breaker.before()
+        if bucket is not None:
+            bucket.take()
+
+    '''
+    Call after every request to 'host' with whether it worked.
+    '''
+    def host_after(self, host, ok):
+        breaker, bucket = self.host_guard(host)
+        if breaker is None:
+            return
+        if ok:
+            breaker.success()
+        elif breaker.failure():
+            self.DEBUG("WARNING: Too many failures from '%s', not asking it again for a while" % (host))
+        self.m_metrics.set("vaccinechecker_circuit_open", { "host" : host }, 0 if CircuitBreaker.CLOSED == breaker.state() else 1)
+
+    '''
+    Return the keep-alive session used for all requests to the host of 'url'.
+    '''
+    def session_for(self, url):
+        host = urlsplit(url).netloc
+        with self.m_httpLock:
+            session = self.m_sessions.get(host)
+            if session is None:
+                import requests
+                import urllib3
+                urllib3.disable_warnings() # for ignoring InsecureRequestWarning for https
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.m_maxConcurrency)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.m_sessions[host] = session
+            return session
+
+    '''
+    GET 'url' on its host's pooled session, subject to the host's circuit breaker and
+    rate limit, counting the response under 'key' in the metrics (bytes are counted
+    here unless streaming).  If a response for 'key' was previously
+    remembered with remember_response(), the request is made conditional with
+    'If-None-Match' / 'If-Modified-Since'.  Returns (response, previous result); if the
+    server answers 304 Not Modified, the caller should reuse the previous result.  Any
+    other answer but a 2xx raises requests.exceptions.HTTPError.
+    '''
+    def http_get(self, url, key, headers=None, **kwargs):
+        headers = dict(headers or {})
+        with self.m_httpLock:
+            validators = self.m_validators.get(key)
+
+        previous = None
+        if validators is not None:
+            etag, lastModified, previous = validators
+            if etag:
+                headers["If-None-Match"] = etag
+            if lastModified:
+                headers["If-Modified-Since"] = lastModified
+
+        host = urlsplit(url).netloc
+        self.host_before(host)
+        try:
+            response = self.session_for(url).get(url, headers=headers, timeout=self.TIMEOUT, **kwargs)
+        except Exception:
+            self.host_after(host, False)
+            raise
+        self.host_after(host, response.status_code < 500)
+        self.m_metrics.inc("vaccinechecker_http_responses_total", { "source" : key, "code" : str(response.status_code) })
+        if not kwargs.get("stream"):
+            self.m_metrics.inc("vaccinechecker_response_bytes_total", { "source" : key }, len(response.content))
+        if 304 == response.status_code and previous is None:
+            import requests
+            raise requests.exceptions.HTTPError("304 Not Modified with nothing cached for '%s'" % (url), response=response)
+        if 304 != response.status_code and not 200 <= response.status_code < 300:
+            # an error page says nothing about availability
+            self.release_response(response)
+            import requests
+            raise requests.exceptions.HTTPError("HTTP %d from '%s'" % (response.status_code, url), response=response)
+        return response, previous
+
+    '''
+    Done with the streaming 'response', read or not.  If at most DRAIN_BYTES of it are
+    left (i.e. a page whose status was decided near its end), they are read off so the
+    connection goes back to its Session for the next request.  A connection with more
+    left, or with a length that isn't known, is closed instead of waited on.
+    '''
+    def release_response(self, response):
+        remaining = response.raw.length_remaining
+        if remaining is not None and remaining <= self.DRAIN_BYTES:
+            try:
+                response.raw.read(remaining, decode_content=False)
+                if 0 == response.raw.length_remaining:
+                    response.raw.release_conn()
+                    return
+            except Exception:
+                pass
+        response.close()
+
+    '''
+    Save the validators of a successful response for 'key', along with 'result', which
+    http_get() hands back on a later 304.
+    '''
+    def remember_response(self, key, response, result):
+        etag = response.headers.get("ETag")
+        lastModified = response.headers.get("Last-Modified")
+        with self.m_httpLock:
+            if 200 == response.status_code and (etag or lastModified):
+                self.m_validators[key] = (etag, lastModified, result)
+            else:
+                self.m_validators.pop(key, None)
+
+    '''
+    Query a single site based on its 'type'.  Called from the worker threads in run(), so
+    it must not touch status; it returns a tuple of (Availability, html), or None if the
+    type is unknown.
+    '''
+    def query_site(self, name):
+
+        start = time.time()
+        try:
+            with self.span("query_" + self.m_websites[name]['type'].lower()):
+                return self.query_site_type(name)
+        finally:
+            elapsed = time.time() - start
+            self.m_latencies[name] = elapsed
+            self.m_metrics.observe("vaccinechecker_request_duration_seconds", { "site" : name }, elapsed)
+
+    def query_site_type(self, name):
+
+        site = self.m_websites[name]
+        provider = self.m_siteProviders.get(name)
+        if provider is None:
+            self.DEBUG("WARNING: Type '%s' for website '%s' not found, skipping..." % (site['type'], name))
+            return None
+
+        # sites sharing a batch key share one fetch per polling period
+        key = provider.batch_key(name, site)
+        if key is None:
+            document = provider.fetch(name, site)
+        else:
+            document = self.m_feedCache.get(key, provider.fetch_batch, self.feed_max_age(name))
+        return provider.parse(name, site, document)
+
+    '''
+    A context manager timing the block it wraps as 'name' when --profile is on, and doing
+    nothing otherwise.
+    '''
+    def span(self, name):
+        if self.m_profiler is None:
+            return self.NO_SPAN
+        return self.m_profiler.span(name)
+
+    '''
+    --profile: start sampling stacks if this cycle is one of every m_profileEvery.
+    Returns the StackSampler, or None.
+    '''
+    def start_profile_cycle(self):
+        self.m_profileCycle += 1
+        if 0 == self.m_profileEvery or 0 != self.m_profileCycle % self.m_profileEvery:
+            return None
+        sampler = StackSampler()
+        sampler.start()
+        return sampler
+
+    '''
+    --profile: log where the cycle's 'cycleTime' seconds went, and write the stack samples (if any) to
+    'profile.[cycle].folded', keeping the newest PROFILE_KEEP.
+    '''
+    def end_profile_cycle(self, sampler, cycleTime):
+        spans = self.m_profiler.end_cycle()
+        self.DEBUG("INFO: Profile of cycle %d: %.3fs; %s" % (self.m_profileCycle, cycleTime, "; ".join("%s %dx %.3fs (longest %.3fs)" % span for span in spans)))
+        if sampler is None:
+            return
+
+        filename = os.path.join(self.m_outputDir, "profile.%d.folded" % (self.m_profileCycle))
+        self.write_atomic(filename, sampler.stop())
+        self.DEBUG("INFO: Wrote stack samples of cycle %d to '%s'" % (self.m_profileCycle, filename))
+        old = sorted(glob.glob(os.path.join(self.m_outputDir, "profile.*.folded")), key=os.path.getmtime)
+        for filename in old[:-self.PROFILE_KEEP]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    '''
+    How old (in seconds) a shared feed may be to answer for 'name': the time until the
+    site is polled again, as things stand (i.e. shorter while it is polled fast), so it
+    never sees anything older than if it had fetched the feed itself last time.
+    '''
+    def feed_max_age(self, name):
+        if self.m_scheduler is not None:
+            period = self.m_scheduler.period(name, time.time())
+            if period is not None:
+                return period
+        return self.site_interval(name)
+
+    '''
+    Seconds between polls of 'name' when nothing unusual is going on.
+    '''
+    def site_interval(self, name):
+        return self.m_websites[name].get('interval', self.m_requestRate)
+
+    '''
+    Query the sites in 'names' once, in parallel (up to m_maxConcurrency at a time).
+    Status is updated from this thread as results come in, so handle_status() is never
+    called concurrently.  Each site is then rescheduled based on how the query went.
+    '''
+    def sweep(self, executor, names):
+
+        futures = {}
+        for name in names:
+            futures[executor.submit(self.query_site, name)] = name
+
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            site = self.m_websites[name]
+            self.m_resultTimes[name] = time.time()
+            try:
+                result = future.result()
+            except Exception as e:
+                import requests
+                # whatever status the site had can no longer be trusted to be current
+                site['stale'] = True
+                if isinstance(e, CircuitOpenError):
+                    self.m_metrics.inc("vaccinechecker_circuit_skips_total", { "site" : name })
+                    self.DEBUG("WARNING: Skipping '%s', %s" % (name, str(e)))
+                elif isinstance(e, ResponseLimitError):
+                    self.m_metrics.inc("vaccinechecker_errors_total", { "site" : name, "type" : type(e).__name__ })
+                    self.DEBUG("WARNING: %s, giving up on it" % (str(e)))
+                elif isinstance(e, requests.exceptions.HTTPError):
+                    self.m_metrics.inc("vaccinechecker_errors_total", { "site" : name, "type" : type(e).__name__ })
+                    self.DEBUG("WARNING: %s, status of '%s' unknown...continuing" % (str(e), name))
+                elif isinstance(e, requests.exceptions.Timeout):
+                    self.m_metrics.inc("vaccinechecker_timeouts_total", { "site" : name })
+                    self.DEBUG("WARNING: Timeout: " + str(e) + "...continuing")
+                else:
+                    self.m_metrics.inc("vaccinechecker_errors_total", { "site" : name, "type" : type(e).__name__ })
+                    self.DEBUG(traceback.format_exc())
+                    self.DEBUG(("ERROR: Error when querying '%s'. Error type %s : %s" % (name, type(e).__name__, str(e))))
+                if isinstance(e, CircuitOpenError):
+                    self.m_scheduler.record_skip(name, e.m_retryAt, time.time())
+                else:
+                    self.m_scheduler.record_failure(name, time.time())
+                if self.m_history is not None:
+                    self.m_history.record_poll(name, self.m_resultTimes[name], None, self.m_latencies.get(name))
+                continue
+
+            if result is None:
+                self.m_scheduler.remove(name)
+                continue
+
+            status, html = result
+            with self.span("handle_status"):
+                changed = self.handle_status(status, name, html)
+            site['update_time'] = time.strftime("%d-%b-%Y %I:%M:%S %p")
+            site['stale'] = False
+            now = time.time()
+            self.m_metrics.set("vaccinechecker_last_success_timestamp_seconds", { "site" : name }, now)
+            self.m_scheduler.record_success(name, status, changed, now)
+            if self.m_history is not None:
+                self.m_history.record_poll(name, self.m_resultTimes[name], status.value, self.m_latencies.get(name))
+
+        if self.m_history is not None:
+            self.m_history.commit()
+
+    '''
+    Write 'filename' without readers ever seeing a partial file:
+    the content goes to a temporary file that is then renamed over 'file'.
+    '''
+    def write_atomic(self, filename, content):
+        tmp = filename + ".tmp"
+        f = open(tmp, "wb" if isinstance(content, bytes) else "w")
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(tmp, filename)
+        return filename
+
+    '''
+    Populate the file we use for communication with PHP, but only if something in it
+    changed, and append any status transitions to the delta file so consumers can
+    follow changes without re-reading all of 'status.json'.
+    '''
+    def write_status(self):
+
+        if (not os.path.exists(self.m_outputDir)):
+            os.makedirs(self.m_outputDir)
+
+        if self.m_transitions:
+            lines = "".join(json.dumps(t, separators=(",", ":")) + "\n" for t in self.m_transitions)
+            f = open(self.m_outputDir + "/" + self.STATUS_DELTA_FILENAME, "a")
+            f.write(lines)
+            f.close()
+            self.m_transitions = []
+
+        content = json.dumps(self.m_websites, separators=(",", ":"), sort_keys=True)
+        contentHash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if contentHash == self.m_statusHash:
+            self.DEBUG("INFO: Status unchanged, not rewriting '%s'" % (self.STATUS_JSON_FILENAME))
+            return
+
+        filename = self.write_atomic(self.m_outputDir + "/" + self.STATUS_JSON_FILENAME, content)
+        self.m_statusHash = contentHash
+        self.DEBUG("INFO: Wrote '%s'" % (filename))
+        self.write_rendered()
+
+        # save off all that we make.  'update_time' changes on every poll, so it is left
+        # out so that snapshots only differ (and take up space) when a status does.
+        if self.m_enableArchive:
+            snapshot = {}
+            for name, site in self.m_websites.items():
+                snapshot[name] = dict((k, v) for k, v in site.items() if k != "update_time")
+            blobHash = self.m_archive.put(self.STATUS_JSON_FILENAME, "status", json.dumps(snapshot, separators=(",", ":"), sort_keys=True))
+            self.DEBUG("INFO: Archiving '%s' as %s" % (self.STATUS_JSON_FILENAME, blobHash))
+
+    '''
+    The text and color of a site's button, as the page's script shows them.
+    '''
+    def site_label(self, name, site):
+        text = "<b>%s</b><br>slots %s available<br>" % (html.escape(name), html.escape(site['status']))
+        text += ("as of " + html.escape(site['update_time'])) if site.get('update_time') else "<br>"
+        if site.get('stale'):
+            text += "<br><i>(site not responding, may be out of date)</i>"
+        return text, self.STATUS_COLORS.get(site['status'], "gray")
+
+    '''
+    The site buttons of 'index.php', filled in as of now.
+    '''
+    def render_status_html(self):
+        lines = []
+        allUrls = ""
+        for name in sorted(self.m_websites):
+            if name in self.HIDDEN_SITES:
+                continue
+            site = self.m_websites[name]
+            # 'website' is only required of 'phrase' sites
+            website = site.get('display_website', site.get('website', ''))
+            onclick = html.escape("window.open(%s, '_blank');" % (json.dumps(website))) if website else ""
+            text, color = self.site_label(name, site)
+            lines.append('<button id="%s" style="background-color: %s" class="button" onclick="%s">%s</button>' % (html.escape(name.replace(" ", "-")), color, onclick, text))
+            allUrls += onclick
+        lines.append('<button style="background-color: #F9F1F0" class="button" onclick="%s">' % (allUrls))
+        lines.append("Open all of them.")
+        lines.append("</button>")
+        return "\n".join(lines) + "\n"
+
+    '''
+    Write the pre-rendered site buttons and the minimal JSON the page refreshes from
+    (only 'status', 'update_time' and 'stale' of each site), along with pre-compressed
+    copies, so a busy web server never has to parse 'status.json' or compress anything.
+    '''
+    def write_rendered(self):
+
+        minimal = {}
+        for name, site in self.m_websites.items():
+            minimal[name] = dict((k, site[k]) for k in self.RUNTIME_FIELDS if k in site)
+        data = json.dumps(minimal, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        if self.m_pushServer is not None:
+            self.m_pushServer.set_snapshot(minimal)
+
+        outputs = [(self.STATUS_HTML_FILENAME, self.render_status_html().encode("utf-8")), (self.STATUS_MIN_JSON_FILENAME, data)]
+        for filename, content in outputs:
+            filename = self.m_outputDir + "/" + filename
+            self.write_atomic(filename + ".gz", gzip.compress(content, 9))
+            if brotli is not None:
+                self.write_atomic(filename + ".br", brotli.compress(content))
+            self.write_atomic(filename, content)
+
+    '''
+    Whether this process polls 'name': always, unless it is a worker and the site is in
+    another worker's shard.
+    '''
+    def is_mine(self, name):
+        return "worker" != self.m_role or name in self.m_assigned
+
+    '''
+    Read a JSON file written by another process in the shard directory.  Returns None if
+    it isn't there (yet) or can't be parsed.
+    '''
+    def read_json(self, filename):
+        try:
+            f = open(filename)
+            content = json.loads(f.read())
+            f.close()
+            return content
+        except (OSError, ValueError):
+            return None
+
+    '''
+    Worker: let the coordinator know this worker is alive.  Runs on its own thread so a
+    long sweep doesn't make the worker look dead.
+    '''
+    def worker_heartbeat(self):
+
+        workersDir = os.path.join(self.m_shardDir, "workers")
+        if not os.path.exists(workersDir):
+            os.makedirs(workersDir)
+        filename = os.path.join(workersDir, self.m_workerId + ".json")
+        while True:
+            try:
+                heartbeat = { "time" : time.time(), "host" : socket.gethostname(), "pid" : os.getpid() }
+                self.write_atomic(filename, json.dumps(heartbeat))
+            except Exception as e:
+                self.DEBUG("WARNING: Could not write heartbeat '%s'. Error type %s : %s" % (filename, type(e).__name__, str(e)))
+            time.sleep(self.WORKER_TIMEOUT / 3)
+
+    '''
+    Worker: pick up the sites the coordinator assigned to this worker.  Sites that moved
+    to this worker are polled right away, unless the checkpoint of a restarted worker
+    has their schedule; sites that moved away are no longer polled.
+    '''
+    def sync_shard(self):
+
+        # the file's own modification time is only good to the second on some shared
+        # file systems (i.e. NFS), too coarse to tell two quick rebalances apart
+        assignment = self.read_json(os.path.join(self.m_shardDir, "assignment.json"))
+        if assignment is None or assignment.get("time") == self.m_assignmentTime:
+            return
+        self.m_assignmentTime = assignment.get("time")
+
+        assigned = set(assignment.get("workers", {}).get(self.m_workerId, []))
+        now = time.time()
+        for name in self.m_assigned - assigned:
+            self.m_scheduler.remove(name)
+            self.m_resultTimes.pop(name, None)
+        for name in assigned - self.m_assigned:
+            if name in self.m_websites:
+                self.m_scheduler.add(name, self.site_interval(name), now)
+                # a restarted worker's sites are only assigned here, after run() started
+                if name in self.m_restoredSchedules:
+                    self.m_scheduler.restore(name, self.m_restoredSchedules.pop(name))
+        if assigned != self.m_assigned:
+            self.DEBUG("INFO: Worker '%s' now polls %d sites (%d added, %d removed)" % (self.m_workerId, len(assigned), len(assigned - self.m_assigned), len(self.m_assigned - assigned)))
+        self.m_assigned = assigned
+
+    '''
+    Worker: hand the latest result of every site in this worker's shard to the
+    coordinator.  Sites not polled yet since they were assigned are left out, so the
+    coordinator keeps what it had for them.
+    '''
+    def write_shard_results(self):
+
+        resultsDir = os.path.join(self.m_shardDir, "results")
+        if not os.path.exists(resultsDir):
+            os.makedirs(resultsDir)
+
+        sites = {}
+        for name in self.m_assigned:
+            if name in self.m_websites and name in self.m_resultTimes:
+                site = self.m_websites[name]
+                sites[name] = { "status" : site['status'], "update_time" : site['update_time'], "stale" : site['stale'], "time" : self.m_resultTimes[name], "latency" : self.m_latencies.get(name) }
+        self.write_atomic(os.path.join(resultsDir, self.m_workerId + ".json"), json.dumps({ "worker" : self.m_workerId, "sites" : sites }))
+
+        # the coordinator reports transitions from the merged results
+        self.m_transitions = []
+
+    '''
+    Coordinator: returns the workers whose heartbeat is recent enough.
+    '''
+    def live_workers(self):
+        workers = []
+        now = time.time()
+        for filename in glob.glob(os.path.join(self.m_shardDir, "workers", "*.json")):
+            heartbeat = self.read_json(filename)
+            if heartbeat is not None and now - heartbeat.get("time", 0) < self.WORKER_TIMEOUT:
+                workers.append(os.path.basename(filename)[:-len(".json")])
+        return sorted(workers)
+
+    '''
+    Coordinator: spread the sites over the live workers, and write the assignment if it
+    changed (i.e. a worker came or went, or 'websites.json' changed).
+    '''
+    def rebalance(self, workers):
+
+        ring = HashRing(workers)
+        assignment = dict((worker, []) for worker in workers)
+        for name in sorted(self.m_websites):
+            worker = ring.node_for(name)
+            if worker is not None:
+                assignment[worker].append(name)
+        if assignment == self.m_assignment:
+            return
+
+        if not workers:
+            self.DEBUG("WARNING: No live workers in '%s', no sites are being polled" % (self.m_shardDir))
+        else:
+            self.DEBUG("INFO: Sites assigned to %d workers: %s" % (len(workers), ", ".join("%s (%d)" % (w, len(assignment[w])) for w in workers)))
+        self.write_atomic(os.path.join(self.m_shardDir, "assignment.json"), json.dumps({ "time" : time.time(), "workers" : assignment }))
+        self.m_assignment = assignment
+
+    '''
+    Coordinator: merge the workers' results into the sites, newest result winning.
+    Sites last reported by a worker that has since died are marked stale until their new
+    worker reports them.  Returns True if any site was updated.
+    '''
+    def merge_results(self, workers):
+
+        updated = False
+        for worker in workers:
+            results = self.read_json(os.path.join(self.m_shardDir, "results", worker + ".json"))
+            if results is None:
+                continue
+            for name, result in results.get("sites", {}).items():
+                if name not in self.m_websites or result["time"] <= self.m_resultTimes.get(name, 0):
+                    continue
+                site = self.m_websites[name]
+                if result["status"] != site['status']:
+                    with self.span("handle_status"):
+                        self.handle_status(Availability(result["status"]), name, "")
+                site['update_time'] = result["update_time"]
+                site['stale'] = result["stale"]
+                self.m_resultTimes[name] = result["time"]
+                self.m_resultOwners[name] = worker
+                if not result["stale"]:
+                    self.m_metrics.set("vaccinechecker_last_success_timestamp_seconds", { "site" : name }, result["time"])
+                if self.m_history is not None:
+                    self.m_history.record_poll(name, result["time"], None if result["stale"] else result["status"], result.get("latency"))
+                updated = True
+
+        for name, worker in list(self.m_resultOwners.items()):
+            if worker not in workers:
+                del self.m_resultOwners[name]
+                if name in self.m_websites and not self.m_websites[name]['stale']:
+                    self.m_websites[name]['stale'] = True
+                    updated = True
+
+        if self.m_history is not None:
+            self.m_history.commit()
+        return updated
+
+    '''
+    Coordinator loop: no sites are queried here, the workers' results are merged into
+    'status.json' and status changes are reported as usual.
+    '''
+    def run_coordinator(self):
+
+        self.m_scheduler = SiteScheduler(self.MIN_REQUEST_RATE, self.VARIANCE)
+        self.DEBUG("INFO: Coordinating workers through '%s'" % (self.m_shardDir))
+        for subdir in ("workers", "results"):
+            if not os.path.exists(os.path.join(self.m_shardDir, subdir)):
+                os.makedirs(os.path.join(self.m_shardDir, subdir))
+
+        # what the last run knew, until the workers report
+        self.write_status()
+
+        try:
+            while True:
+                reloaded = self.check_websites()
+                workers = self.live_workers()
+                self.rebalance(workers)
+
+                try:
+                    if self.merge_results(workers) or reloaded:
+                        writeStart = time.time()
+                        self.write_status()
+                        self.m_metrics.observe("vaccinechecker_status_write_duration_seconds", None, time.time() - writeStart)
+                    if "" != self.m_metricsFile:
+                        self.write_atomic(self.m_metricsFile, self.m_metrics.render())
+
+                    time.sleep(self.COORDINATOR_INTERVAL)
+                    self.check_heartbeat()
+
+                except Exception as e:
+                    self.DEBUG(traceback.format_exc())
+                    self.send_message("ERROR: Error during processing of type %s : %s ... %s." % (type(e).__name__, str(e), "restarting" if self.m_supervised else "exiting"))
+                    sys.exit(-1)
+
+        finally:
+            if self.m_history is not None:
+                self.m_history.close()
+            if self.m_notifier is not None:
+                self.m_notifier.close()
+
+    '''
+    Workers hand their results to the coordinator; everyone else writes 'status.json'.
+    '''
+    def write_output(self):
+        if "worker" == self.m_role:
+            self.write_shard_results()
+        else:
+            self.write_status()
+
+    '''
+    primary loop.  query the self.m_websites and keep track of status.
+    '''
+    def run(self):
+
+        if "coordinator" == self.m_role:
+            return self.run_coordinator()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.m_maxConcurrency)
+
+        self.m_scheduler = SiteScheduler(self.MIN_REQUEST_RATE, self.VARIANCE)
+        now = time.time()
+        for name in self.m_websites:
+            if self.is_mine(name):
+                self.m_scheduler.add(name, self.site_interval(name), now)
+                if name in self.m_restoredSchedules:
+                    self.m_scheduler.restore(name, self.m_restoredSchedules.pop(name))
+
+        if "worker" == self.m_role:
+            thread = threading.Thread(target=self.worker_heartbeat, name="heartbeat")
+            thread.daemon = True
+            thread.start()
+        else:
+            # what the last run knew, until the first sweep is done
+            self.write_status()
+
+        try:
+            # primary loop
+            while self.m_attempts < self.MAX_ATTEMPTS or self.MAX_ATTEMPTS == 0:
+
+                reloaded = self.check_websites()
+                if "worker" == self.m_role:
+                    self.sync_shard()
+
+                names = self.m_scheduler.pop_due(time.time())
+                profiling = names and self.m_profiler is not None
+                if profiling:
+                    sampler = self.start_profile_cycle()
+                    cycleStart = time.perf_counter()
+                if names:
+                    sweepStart = time.time()
+                    with self.span("sweep"):
+                        self.sweep(executor, names)
+                    sweepTime = time.time() - sweepStart
+                    self.m_metrics.observe("vaccinechecker_sweep_duration_seconds", None, sweepTime)
+                    self.DEBUG("INFO: Queried %d sites in %.2f seconds" % (len(names), sweepTime))
+
+                try:
+
+                    if reloaded and not names:
+                        self.write_output()
+
+                    if names:
+                        writeStart = time.time()
+                        with self.span("write_status"):
+                            self.write_output()
+                        self.m_metrics.observe("vaccinechecker_status_write_duration_seconds", None, time.time() - writeStart)
+                        if profiling:
+                            self.end_profile_cycle(sampler, time.perf_counter() - cycleStart)
+
+                        self.m_attempts += 1
+                        self.m_metrics.inc("vaccinechecker_sweeps_total")
+                        if "" != self.m_metricsFile:
+                            self.write_atomic(self.m_metricsFile, self.m_metrics.render())
+                        if self.m_supervised and time.time() - self.m_lastCheckpoint >= self.CHECKPOINT_INTERVAL:
+                            self.write_checkpoint()
+                        if self.m_attempts >= self.MAX_ATTEMPTS and self.MAX_ATTEMPTS != 0:
+                            break
+                
+                    # give the good servers some time to rest, waking up early for the heartbeat
+                    sleeptime = self.m_requestRate
+                    nextDue = self.m_scheduler.next_due()
+                    if nextDue is not None:
+                        sleeptime = nextDue - time.time()
+                    if self.m_nextHeartbeat:
+                        sleeptime = min(sleeptime, self.m_nextHeartbeat - time.time())
+                    sleeptime = max(0, sleeptime)
+                    if names:
+                        self.DEBUG("INFO: checking again in %d seconds (%s)..." % (sleeptime, timedelta(seconds=int(sleeptime))))
+
+                    # wake up now and then to look for changes to 'websites.json'
+                    time.sleep(min(sleeptime, self.RELOAD_CHECK_INTERVAL))
+
+                    self.check_heartbeat()
+
+                except Exception as e:
+                    self.DEBUG(traceback.format_exc())
+                    self.send_message("ERROR: Error during processing of type %s : %s ... %s." % (type(e).__name__, str(e), "restarting" if self.m_supervised else "exiting"))
+                    sys.exit(-1)
+
+        finally:
+            # don't leave browser processes behind, even when exiting on an error
+            executor.shutdown(wait=False)
+
+            # the next worker starts from here (whatever went wrong may well stop this too)
+            if self.m_supervised:
+                try:
+                    self.write_checkpoint()
+                except Exception as e:
+                    self.DEBUG("WARNING: Could not write checkpoint. Error type %s : %s" % (type(e).__name__, str(e)))
+            for provider in self.m_providers.values():
+                provider.close()
+
+            # let the coordinator move this worker's sites right away, unless another worker
+            # is about to take over from this one
+            exiting = sys.exc_info()[1]
+            crashed = exiting is not None and not (isinstance(exiting, SystemExit) and exiting.code in (0, None))
+            if "worker" == self.m_role and not (self.m_supervised and crashed):
+                try:
+                    os.remove(os.path.join(self.m_shardDir, "workers", self.m_workerId + ".json"))
+                except OSError:
+                    pass
+
+            if self.m_history is not None:
+                self.m_history.close()
+
+            # give queued emails (i.e. the reason for exiting) a chance to go out
+            if self.m_notifier is not None:
+                self.m_notifier.close()
+
+        self.DEBUG("INFO: All done.  Bye!")
+
+'''
+--supervise: runs the polling worker, start(restarts), in a forked child process and
+starts a new one whenever it stops without the supervisor asking it to or finishing its
+--max-attempts sweeps, i.e. after an error writing 'status.json', an exception outside
+a query, or being killed.  The new worker restores
+the checkpoint the last one wrote, and 'status.json' is left as it was in between, so
+'index.php' keeps serving the last good status.  A worker dying again within
+RESTART_WINDOW seconds of starting is restarted after a growing delay, so a lasting
+problem doesn't become a tight loop.
+
+The supervisor starts no threads, so forking it is safe, and what it imports (i.e.
+'requests', while the first worker starts) every later worker has from the start.
+'''
+class Supervisor(object):
+
+    RESTART_WINDOW = 60 # seconds
+    MAX_RESTART_DELAY = 60 # seconds
+    FINISHED = 10 # exit code of a worker that ran to the end, i.e. after --max-attempts sweeps
+
+    def __init__(self, start):
+        self.m_start = start
+        self.m_pid = 0 # of the running worker, 0 if none
+        self.m_stopping = False
+        self.m_quickRestarts = 0 # workers in a row that died within RESTART_WINDOW
+
+    def log(self, x):
+        print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), x), flush=True)
+
+    '''
+    Ctrl+C / SIGTERM stop the worker, then the supervisor; the worker is sent SIGINT,
+    the only signal it exits cleanly on.  SIGHUP is passed on, to re-read 'websites.json'.
+    '''
+    def forward(self, sig, frame):
+        if signal.SIGHUP != sig:
+            self.m_stopping = True
+        if self.m_pid:
+            try:
+                os.kill(self.m_pid, sig if signal.SIGHUP == sig else signal.SIGINT)
+            except OSError:
+                pass
+
+    '''
+    Fork a worker.  Returns its process ID; the worker itself never returns.
+    '''
+    def spawn(self, restarts):
+        sys.stdout.flush()
+        pid = os.fork()
+        if 0 != pid:
+            return pid
+
+        # its own process group, so a Ctrl+C in the terminal reaches it only once, from here
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGINT, SignalHandler)
+        signal.signal(signal.SIGTERM, WorkerTermHandler)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        code = self.FINISHED
+        try:
+            self.m_start(restarts)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else -1)
+        except BaseException:
+            traceback.print_exc()
+            code = -1
+        if LOG_LISTENER is not None:
+            LOG_LISTENER.stop()
+        sys.stdout.flush()
+        os._exit(code)
+
+    '''
+    Keep a worker running until the supervisor is told to stop or a worker finishes; a
+    worker that exits any other way, even with 0, is restarted.  Returns the last
+    worker's exit code, 0 if it finished.
+    '''
+    def run(self):
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, self.forward)
+
+        restarts = 0
+        while True:
+            started = time.time()
+            self.m_pid = self.spawn(restarts)
+            self.log("INFO: Started worker %d" % (self.m_pid))
+            if 0 == restarts:
+                import requests
+
+            pid, status = os.waitpid(self.m_pid, 0)
+            self.m_pid = 0
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            if self.FINISHED == code:
+                self.log("INFO: Worker %d finished, stopping" % (pid))
+                return 0
+            if self.m_stopping:
+                self.log("INFO: Worker %d exited with %d, stopping" % (pid, code))
+                return code
+
+            self.m_quickRestarts = self.m_quickRestarts + 1 if time.time() - started < self.RESTART_WINDOW else 0
+            delay = 0 if self.m_quickRestarts < 2 else min(self.MAX_RESTART_DELAY, 2 ** (self.m_quickRestarts - 2))
+            how = "exited with %d" % (code) if code >= 0 else "was killed by signal %d" % (-code)
+            self.log("ERROR: Worker %d %s, starting another%s" % (pid, how, " in %d seconds" % (delay) if delay else ""))
+            deadline = time.time() + delay
+            while time.time() < deadline and not self.m_stopping:
+                time.sleep(0.1)
+            if self.m_stopping:
+                self.log("INFO: Stopping")
+                return code
+            restarts += 1
+
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGINT, SignalHandler)
+
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
             '--websites',
             action="store",
             dest="websitesFile",
@@ -574,6 +3414,51 @@ if __name__ == "__main__":
             metavar="[x]",
             default="")
 
+    parser.add_argument(
+            '--notification-window',
+            action="store",
+            dest="notificationWindow",
+            help="If passed with --notification-rate, how many seconds of status changes are gathered into a single email.  Default is 60 seconds.",
+            required=False,
+            metavar="[x]",
+            default=60)
+
+    parser.add_argument(
+            '--max-attempts',
+            action="store",
+            dest="maxAttempts",
+            help="If passed, the program exits after querying sites this many times.  Default is to run forever.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--cvs-url',
+            action="store",
+            dest="cvsUrl",
+            help="Overrides the URL of the CVS state feed, with '{}' where the state goes.  For testing against a stand-in server (see 'benchmark.py').",
+            required=False,
+            metavar="[x]",
+            default=vaccineChecker.CVS_URL)
+
+    parser.add_argument(
+            '--heb-url',
+            action="store",
+            dest="hebUrl",
+            help="Overrides the URL of the HEB locations feed.  For testing against a stand-in server (see 'benchmark.py').",
+            required=False,
+            metavar="[x]",
+            default=vaccineChecker.HEB_URL)
+
+    parser.add_argument(
+            '--cities',
+            action="store",
+            dest="citiesFile",
+            help="The table of city coordinates CVS sites with a 'radius' are looked up in, as 'state,city,latitude,longitude' lines.  Default is the 'input/cities.csv' of this source tree.",
+            required=False,
+            metavar="[file]",
+            default=vaccineChecker.CITIES_FILENAME)
+
     parser.add_argument(
             '--archive',
             action="store_true",
@@ -582,11 +3467,28 @@ if __name__ == "__main__":
             required=False,
             default=False)
 
+    parser.add_argument(
+            '--history',
+            action="store_true",
+            dest="enableHistory",
+            help="If enabled, records every poll result and status change in '%s' in the directory specified in --output-dir.  See 'history.py --help' for querying it." % (vaccineChecker.HISTORY_FILENAME),
+            required=False,
+            default=False)
+
+    parser.add_argument(
+            '--archive-retention',
+            action="store",
+            dest="archiveRetention",
+            help="If passed with --archive, how many days archives are kept.  Default is to keep them forever.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
     parser.add_argument(
             '--request-rate',
             action="store",
             dest="requestRate",
-            help="How often, in seconds, the status will be requested from the sites in 'websites.json'.  Default is 300 seconds (5 minutes).  Up to a 10 second jitter is intentionally added every request.",
+            help="How often, in seconds, the status will be requested from the sites in 'websites.json'.  Default is 300 seconds (5 minutes).  A site can set its own rate with 'interval'.  Sites are polled more often right after they show availability, and less often when they fail or haven't changed in hours.  Up to a 10 second jitter is intentionally added every request.",
             required=False,
             metavar="[x]",
             default=5*60)
@@ -598,7 +3500,148 @@ if __name__ == "__main__":
             help="If passed, prints out function name and process ID when logging.",
             required=False,
             default=False)
+
+    parser.add_argument(
+            '--log-level',
+            action="store",
+            dest="logLevel",
+            help="Only log messages at or above this level: ERROR, WARNING, INFO or DEBUG.  Default is INFO.",
+            required=False,
+            metavar="[x]",
+            default="INFO")
+
+    parser.add_argument(
+            '--log-format',
+            action="store",
+            dest="logFormat",
+            help="'text' for the usual log lines, or 'json' for one JSON object per line.  Default is 'text'.",
+            required=False,
+            metavar="[x]",
+            default="text")
+
+    parser.add_argument(
+            '--metrics-port',
+            action="store",
+            dest="metricsPort",
+            help="If passed, serves Prometheus metrics (request latency, bytes, status codes, timeouts, errors, status changes, sweep and 'status.json' write times) on http://127.0.0.1:[x]/metrics.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--push-port',
+            action="store",
+            dest="pushPort",
+            help="If passed, pushes status changes to browsers as Server-Sent Events on http://127.0.0.1:[x]/events (i.e. behind the web server's reverse proxy), so 'index.php' doesn't have to poll.",
+            required=False,
+            metavar="[x]",
+            default=0)
+
+    parser.add_argument(
+            '--metrics-file',
+            action="store",
+            dest="metricsFile",
+            help="If passed, the same metrics as --metrics-port are written to this file after every sweep, for the node exporter's textfile collector (i.e. /var/lib/node_exporter/vaccinechecker.prom).",
+            required=False,
+            metavar="[x]",
+            default="")
+
+    parser.add_argument(
+            '--max-concurrency',
+            action="store",
+            dest="maxConcurrency",
+            help="How many sites in 'websites.json' are queried at the same time.  A sweep over all sites takes roughly as long as its slowest site when this is at least the number of sites.  Default is %d." % (vaccineChecker.DEFAULT_MAX_CONCURRENCY),
+            required=False,
+            metavar="[x]",
+            default=vaccineChecker.DEFAULT_MAX_CONCURRENCY)
+
+    parser.add_argument(
+            '--max-browsers',
+            action="store",
+            dest="maxBrowsers",
+            help="How many headless browsers are kept for sites that need navigation (i.e. 'walgreens'), so that many of those sites can be queried at the same time.  Default is %d." % (vaccineChecker.DEFAULT_MAX_BROWSERS),
+            required=False,
+            metavar="[x]",
+            default=vaccineChecker.DEFAULT_MAX_BROWSERS)
+
+    parser.add_argument(
+            '--host-rate',
+            action="store",
+            dest="hostRate",
+            help="The most requests per second sent to any one provider host, with bursts of up to %d.  0 means no limit.  Default is %d." % (vaccineChecker.HOST_BURST, vaccineChecker.DEFAULT_HOST_RATE),
+            required=False,
+            metavar="[x]",
+            default=vaccineChecker.DEFAULT_HOST_RATE)
     
+    parser.add_argument(
+            '--no-circuit-breaker',
+            action="store_false",
+            dest="circuitBreakers",
+            help="Keep sending requests to a provider host however many fail in a row.  By default a host is left alone for a while after %d failures in a row.  For benchmarking." % (CircuitBreaker.FAILURE_THRESHOLD),
+            required=False,
+            default=True)
+
+    parser.add_argument(
+            '--provider',
+            action="append",
+            dest="providers",
+            help="Adds a site 'type' handled by a provider plugin, as [type]=[module]:[class], where the class is a subclass of 'vaccineChecker.Provider'.  Can be passed more than once.  Built in types are %s." % (", ".join(sorted(PROVIDERS))),
+            required=False,
+            metavar="[type]=[module]:[class]",
+            default=[])
+
+    parser.add_argument(
+            '--profile',
+            action="store_true",
+            dest="profile",
+            help="Times each cycle and the site queries, status updates, 'status.json' writes and emails in it, and logs where the time went after every cycle.  Also adds 'vaccinechecker_span_duration_seconds' to the metrics.",
+            required=False,
+            default=False)
+
+    parser.add_argument(
+            '--profile-every',
+            action="store",
+            dest="profileEvery",
+            help="With --profile, also sample the stacks of every thread during every [x]th cycle, written as 'profile.[cycle].folded' (collapsed stacks, for flame graph tools) in --output-dir.  The newest %d are kept.  Default is 0, never." % (vaccineChecker.PROFILE_KEEP),
+            required=False,
+            metavar="[x]",
+            default="0")
+
+    parser.add_argument(
+            '--supervise',
+            action="store_true",
+            dest="supervise",
+            help="Polls from a child process, which is started again (within a second, with its state restored from a checkpoint in --output-dir) if it crashes or is killed.  'status.json' keeps its last good content in the meantime.",
+            required=False,
+            default=False)
+
+    parser.add_argument(
+            '--role',
+            action="store",
+            dest="role",
+            help="'standalone' polls every site in 'websites.json'.  'coordinator' polls nothing itself: it splits the sites between the workers sharing --shard-dir, merges their results into 'status.json' and sends the emails.  'worker' polls only the sites the coordinator gives it.  Default is 'standalone'.",
+            required=False,
+            metavar="[role]",
+            default="standalone")
+
+    parser.add_argument(
+            '--shard-dir',
+            action="store",
+            dest="shardDir",
+            help="Directory shared by the coordinator and its workers (i.e. on the same host, or over NFS), used with --role.",
+            required=False,
+            metavar="[dir]",
+            default="")
+
+    parser.add_argument(
+            '--worker-id',
+            action="store",
+            dest="workerId",
+            help="Name of this worker, unique among the workers of a coordinator.  Keeping it the same across restarts keeps the worker's sites.  Default is '<hostname>-<pid>'.",
+            required=False,
+            metavar="[id]",
+            default="")
+
     args = parser.parse_args()
 
     try:
@@ -607,6 +3650,38 @@ if __name__ == "__main__":
         print("ERROR: --request-rate must be a number")
         sys.exit(-1)
 
+    try:
+        args.maxConcurrency = int(args.maxConcurrency)
+        if (args.maxConcurrency < 1):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --max-concurrency must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.maxBrowsers = int(args.maxBrowsers)
+        if (args.maxBrowsers < 1):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --max-browsers must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.hostRate = float(args.hostRate)
+        if (args.hostRate < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --host-rate must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.archiveRetention = int(args.archiveRetention)
+        if (args.archiveRetention < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --archive-retention must be a positive number")
+        sys.exit(-1)
+
     if ("" != args.credentialsFile and "" == args.notificationRate):
         print("INFO: 'credentials.json' location specified, but --notification-rate not passed.  Assuming default notification rate of 60 minutes.")
         args.notificationRate = "60"
@@ -626,5 +3701,86 @@ if __name__ == "__main__":
     else:
         args.notificationRate = 0
 
-    vc = vaccineChecker(args.websitesFile, args.outputDir, args.credentialsFile, args.notificationRate, args.enableArchive, args.requestRate, args.verbose)
-    vc.run()
+    if (args.logLevel.upper() not in LOG_LEVELS):
+        print("ERROR: --log-level must be one of %s" % (", ".join(LOG_LEVELS)))
+        sys.exit(-1)
+
+    providers = {}
+    for provider in args.providers:
+        siteType, sep, path = provider.partition("=")
+        if not sep or ":" not in path:
+            print("ERROR: --provider must be [type]=[module]:[class]")
+            sys.exit(-1)
+        providers[siteType.strip().lower()] = path.strip()
+    args.providers = providers
+
+    if (args.role not in vaccineChecker.ROLES):
+        print("ERROR: --role must be one of %s" % (", ".join(vaccineChecker.ROLES)))
+        sys.exit(-1)
+
+    if ("standalone" != args.role and "" == args.shardDir):
+        print("ERROR: --shard-dir must be passed with --role %s" % (args.role))
+        sys.exit(-1)
+
+    if (args.logFormat not in ("text", "json")):
+        print("ERROR: --log-format must be 'text' or 'json'")
+        sys.exit(-1)
+
+    try:
+        args.maxAttempts = int(args.maxAttempts)
+        if (args.maxAttempts < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --max-attempts must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.profileEvery = int(args.profileEvery)
+        if (args.profileEvery < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --profile-every must be a positive number")
+        sys.exit(-1)
+
+    if (0 != args.profileEvery and not args.profile):
+        print("ERROR: --profile must be passed with --profile-every")
+        sys.exit(-1)
+
+    try:
+        args.pushPort = int(args.pushPort)
+        if (args.pushPort < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --push-port must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.metricsPort = int(args.metricsPort)
+        if (args.metricsPort < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --metrics-port must be a positive number")
+        sys.exit(-1)
+
+    try:
+        args.notificationWindow = int(args.notificationWindow)
+        if (args.notificationWindow < 0):
+            raise Exception()
+    except Exception as e:
+        print("ERROR: --notification-window must be a positive number")
+        sys.exit(-1)
+
+    # a restarted worker must keep its identity, or the coordinator moves its sites
+    if (args.supervise and "" == args.workerId):
+        args.workerId = "%s-%d" % (socket.gethostname(), os.getpid())
+
+    def start(restarts=0):
+        vc = vaccineChecker(args.websitesFile, args.outputDir, args.credentialsFile, args.notificationRate, args.enableArchive, args.requestRate, args.verbose, args.maxConcurrency, args.maxBrowsers, args.archiveRetention, args.notificationWindow, args.logLevel, args.logFormat, args.metricsPort, args.metricsFile, args.maxAttempts, args.cvsUrl, args.hebUrl, args.hostRate, args.role, args.shardDir, args.workerId, args.enableHistory, args.pushPort, args.providers, args.citiesFile, args.profile, args.profileEvery, args.supervise, restarts > 0, args.circuitBreakers)
+        # re-read 'websites.json' on 'kill -HUP'
+        signal.signal(signal.SIGHUP, lambda sig, frame: vc.request_reload())
+
+        vc.run()
+
+    if args.supervise:
+        sys.exit(0 if 0 == Supervisor(start).run() else -1)
+    start()